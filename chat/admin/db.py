@@ -1,12 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Blueprint, Flask, current_app, render_template, request, redirect, url_for, session, flash, jsonify
 import sqlite3
-import pandas as pd
 from datetime import datetime
+import glob
 import os
+import re
+import sys
+import threading
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-app.config['DATABASE'] = 'chat_app.db'
+# Общие модули чата (ratelimit.py, settings.py) лежат уровнем выше
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ratelimit import ConcurrencyLimiter, create_limiter, retry_after_header, route_buckets
+from settings import load_config, load_secret_key
+
+class DefaultConfig:
+    """Настройки по умолчанию; переопределяются файлом из переменной ADMIN_SETTINGS,
+    переменными окружения ADMIN_* и аргументом create_app"""
+    # Без SECRET_KEY ключ создается при первом запуске в SECRET_KEY_FILE
+    SECRET_KEY = None
+    SECRET_KEY_FILE = 'key/secret_key'
+    DATABASE = 'chat_app.db'
+    SHARD_FOLDER = 'shards'
+
+    # Ограничение /api/query: корзины токенов (токенов в секунду, емкость) по
+    # администратору и IP; 'redis' - общие корзины для нескольких процессов
+    RATE_LIMIT_BACKEND = 'memory'
+    REDIS_URL = 'redis://localhost:6379/0'
+    QUERY_RATE_LIMITS = {'user': (0.5, 10), 'ip': (1, 20)}
+    # Одновременные запросы: каждый читает результат целиком в память
+    MAX_CONCURRENT_QUERIES = 2
+
+bp = Blueprint('admin', __name__, cli_group=None)
+
+# Таблицы, которые в режиме шардирования хранятся в базах шардов
+SHARD_TABLES = ('messages', 'files')
+
+# Комнат и пользователей в рейтинге занятого места /api/stats
+TOP_USAGE_LIMIT = 10
 
 # Данные для авторизации
 VALID_USERNAME = 'Va_Dar'
@@ -18,10 +47,54 @@ SSL_PRIVATE_KEY = 'key/privkey.pem'
 
 def get_db_connection():
     """Создает соединение с базой данных"""
-    conn = sqlite3.connect(app.config['DATABASE'])
+    conn = sqlite3.connect(current_app.config['DATABASE'])
     conn.row_factory = sqlite3.Row
     return conn
 
+def get_shard_paths():
+    """Возвращает пути к базам шардов в порядке номеров"""
+    paths = glob.glob(os.path.join(current_app.config['SHARD_FOLDER'], 'shard_*.db'))
+    return sorted(paths, key=lambda path: int(re.search(r'shard_(\d+)\.db$', path).group(1)))
+
+def get_shard_connection(path):
+    """Создает соединение с шардом, основная база подключается как core"""
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute('ATTACH DATABASE ? AS core', (current_app.config['DATABASE'],))
+    return conn
+
+def get_shard_sources():
+    """Пары (имя, соединение): основная база и все шарды"""
+    sources = [('main', get_db_connection())]
+    for path in get_shard_paths():
+        name = os.path.splitext(os.path.basename(path))[0]
+        sources.append((name, get_shard_connection(path)))
+    return sources
+
+def read_query(conn, query):
+    """Выполняет SELECT и возвращает строки списком словарей"""
+    return [dict(row) for row in conn.execute(query).fetchall()]
+
+def read_query_across_shards(query):
+    """Выполняет SELECT в основной базе и во всех шардах, добавляя колонку _shard"""
+    rows = []
+    for name, conn in get_shard_sources():
+        try:
+            rows.extend({'_shard': name, **row} for row in read_query(conn, query))
+        finally:
+            conn.close()
+    return rows
+
+limiter_lock = threading.Lock()
+
+def get_query_limiters():
+    """Ограничитель частоты и счетчик одновременных запросов /api/query"""
+    with limiter_lock:
+        if 'query_limiters' not in current_app.extensions:
+            current_app.extensions['query_limiters'] = (create_limiter(current_app.config),
+                                                ConcurrencyLimiter(current_app.config['MAX_CONCURRENT_QUERIES']))
+        return current_app.extensions['query_limiters']
+
 def check_ssl_files():
     """Проверяет наличие SSL файлов"""
     if not os.path.exists(SSL_CERTIFICATE):
@@ -34,18 +107,18 @@ def check_auth():
     """Проверяет авторизацию пользователя"""
     return session.get('authenticated') == True
 
-@app.route('/')
+@bp.route('/')
 def index():
     """Главная страница с авторизацией"""
     if check_auth():
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
+        return redirect(url_for('admin.dashboard'))
+    return redirect(url_for('admin.login'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Страница авторизации"""
     if check_auth():
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('admin.dashboard'))
     
     if request.method == 'POST':
         username = request.form.get('username')
@@ -55,28 +128,28 @@ def login():
             session['authenticated'] = True
             session['username'] = username
             flash('Успешный вход!', 'success')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('admin.dashboard'))
         else:
             flash('Неверные учетные данные!', 'error')
     
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Выход из системы"""
     session.clear()
     flash('Вы вышли из системы', 'info')
-    return redirect(url_for('login'))
+    return redirect(url_for('admin.login'))
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 def dashboard():
     """Панель управления базы данных"""
     if not check_auth():
-        return redirect(url_for('login'))
+        return redirect(url_for('admin.login'))
     
     return render_template('dashboard.html', username=session.get('username'))
 
-@app.route('/api/tables')
+@bp.route('/api/tables')
 def get_tables():
     """API для получения списка таблиц"""
     if not check_auth():
@@ -88,11 +161,12 @@ def get_tables():
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
         tables = [table[0] for table in cursor.fetchall()]
         conn.close()
-        return jsonify({'tables': tables})
+        shards = [os.path.splitext(os.path.basename(path))[0] for path in get_shard_paths()]
+        return jsonify({'tables': tables, 'shards': shards})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/table/<table_name>')
+@bp.route('/api/table/<table_name>')
 def get_table_data(table_name):
     """API для получения данных таблицы"""
     if not check_auth():
@@ -106,11 +180,14 @@ def get_table_data(table_name):
         cursor.execute(f"PRAGMA table_info({table_name})")
         columns = [{'name': col[1], 'type': col[2]} for col in cursor.fetchall()]
         
-        # Получаем данные
-        df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-        data = df.to_dict('records')
-        
-        conn.close()
+        # Получаем данные; таблицы шардов собираем из всех баз
+        if table_name in SHARD_TABLES and get_shard_paths():
+            conn.close()
+            data = read_query_across_shards(f"SELECT * FROM {table_name}")
+            columns.insert(0, {'name': '_shard', 'type': 'TEXT'})
+        else:
+            data = read_query(conn, f"SELECT * FROM {table_name}")
+            conn.close()
         
         return jsonify({
             'table_name': table_name,
@@ -121,7 +198,7 @@ def get_table_data(table_name):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/stats')
+@bp.route('/api/stats')
 def get_database_stats():
     """API для получения статистики базы данных"""
     if not check_auth():
@@ -132,36 +209,101 @@ def get_database_stats():
         cursor = conn.cursor()
         
         stats = {}
-        tables = ['users', 'rooms', 'messages', 'files']
+        tables = ['users', 'rooms']
         
         for table in tables:
             cursor.execute(f"SELECT COUNT(*) FROM {table}")
             stats[table] = cursor.fetchone()[0]
+        conn.close()
         
-        # Дополнительная статистика
-        cursor.execute("SELECT COUNT(DISTINCT room_link) FROM messages")
-        stats['active_rooms'] = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM messages")
-        stats['active_users'] = cursor.fetchone()[0]
+        # Сообщения и файлы суммируем по основной базе и всем шардам
+        stats['messages'] = 0
+        stats['files'] = 0
+        stats['active_rooms'] = 0
+        stats['files_size'] = 0
+        stats['files_stored_size'] = 0
+        stats['last_message'] = None
+        active_users = set()
+        top_rooms = []
+        user_usage = {}
+        for name, conn in get_shard_sources():
+            cursor = conn.cursor()
+            for table in SHARD_TABLES:
+                cursor.execute(f"SELECT COUNT(*) FROM {table}")
+                stats[table] += cursor.fetchone()[0]
+            
+            # Комната целиком живет в одном шарде, поэтому счетчики складываются
+            cursor.execute("SELECT COUNT(DISTINCT room_link) FROM messages")
+            stats['active_rooms'] += cursor.fetchone()[0]
+            
+            # Исходный размер файлов и фактически занятое место (с учетом сжатия)
+            # берутся из счетчиков чата, а не суммированием по files
+            cursor.execute("SELECT COALESCE(SUM(file_size), 0), COALESCE(SUM(stored_size), 0) FROM room_usage")
+            files_size, files_stored_size = cursor.fetchone()
+            stats['files_size'] += files_size
+            stats['files_stored_size'] += files_stored_size
+            
+            cursor.execute("SELECT * FROM room_usage ORDER BY stored_size DESC LIMIT ?", (TOP_USAGE_LIMIT,))
+            top_rooms.extend(dict(row) for row in cursor.fetchall())
+            for row in cursor.execute("SELECT * FROM user_usage").fetchall():
+                usage = user_usage.setdefault(row['user_id'], {'user_id': row['user_id'], 'files': 0,
+                                                               'file_size': 0, 'stored_size': 0})
+                for key in ('files', 'file_size', 'stored_size'):
+                    usage[key] += row[key]
+            
+            cursor.execute("SELECT DISTINCT user_id FROM messages")
+            active_users.update(row[0] for row in cursor.fetchall())
+            
+            cursor.execute("SELECT MAX(timestamp) FROM messages")
+            last_message = cursor.fetchone()[0]
+            if last_message and (stats['last_message'] is None or last_message > stats['last_message']):
+                stats['last_message'] = last_message
+            conn.close()
         
-        cursor.execute("SELECT MAX(timestamp) FROM messages")
-        stats['last_message'] = cursor.fetchone()[0]
+        stats['active_users'] = len(active_users)
         
+        # Комнаты и пользователи, занимающие больше всего места
+        conn = get_db_connection()
+        stats['top_rooms'] = sorted(top_rooms, key=lambda row: row['stored_size'], reverse=True)[:TOP_USAGE_LIMIT]
+        for row in stats['top_rooms']:
+            room = conn.execute("SELECT name FROM rooms WHERE link = ?", (row['room_link'],)).fetchone()
+            row['name'] = room['name'] if room else None
+        stats['top_users'] = sorted(user_usage.values(), key=lambda row: row['stored_size'],
+                                    reverse=True)[:TOP_USAGE_LIMIT]
+        for row in stats['top_users']:
+            user = conn.execute("SELECT username FROM users WHERE id = ?", (row['user_id'],)).fetchone()
+            row['username'] = user['username'] if user else None
         conn.close()
         return jsonify(stats)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/query', methods=['POST'])
+@bp.route('/api/query', methods=['POST'])
 def execute_query():
     """API для выполнения SQL запросов"""
     if not check_auth():
         return jsonify({'error': 'Unauthorized'}), 401
     
+    rate_limiter, query_slots = get_query_limiters()
+    buckets = route_buckets('query', current_app.config['QUERY_RATE_LIMITS'],
+                            {'user': session.get('username'), 'ip': request.remote_addr})
+    retry_after = rate_limiter.hit(buckets)
+    if retry_after:
+        return jsonify({'error': 'Too many requests'}), 429, {'Retry-After': retry_after_header(retry_after)}
+    
+    if not query_slots.try_acquire():
+        return jsonify({'error': 'Too many concurrent queries'}), 503, {'Retry-After': '1'}
+    try:
+        return run_query()
+    finally:
+        query_slots.release()
+
+def run_query():
+    """Выполняет SQL запрос из тела запроса /api/query"""
     try:
         data = request.get_json()
         query = data.get('query', '').strip()
+        across_shards = bool(data.get('shards'))
         
         if not query:
             return jsonify({'error': 'Query is empty'}), 400
@@ -171,11 +313,21 @@ def execute_query():
         if any(keyword in query.upper() for keyword in dangerous_keywords):
             return jsonify({'error': 'Operation not allowed'}), 403
         
+        if across_shards:
+            if not query.upper().startswith('SELECT'):
+                return jsonify({'error': 'Only SELECT is allowed across shards'}), 400
+            
+            result = read_query_across_shards(query)
+            return jsonify({
+                'success': True,
+                'data': result,
+                'count': len(result)
+            })
+        
         conn = get_db_connection()
         
         if query.upper().startswith('SELECT'):
-            df = pd.read_sql_query(query, conn)
-            result = df.to_dict('records')
+            result = read_query(conn, query)
             conn.close()
             return jsonify({
                 'success': True,
@@ -195,7 +347,16 @@ def execute_query():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def create_app(config=None):
+    """Создает приложение администрирования; config переопределяет остальные настройки"""
+    app = Flask(__name__)
+    load_config(app, DefaultConfig, 'ADMIN', config)
+    load_secret_key(app)
+    app.register_blueprint(bp)
+    return app
+
 if __name__ == '__main__':
+    app = create_app()
     try:
         # Проверяем наличие SSL файлов
         check_ssl_files()
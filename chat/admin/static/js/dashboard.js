@@ -56,9 +56,28 @@ class DatabaseViewer {
                 <div class="stat-value">${stats.files || 0}</div>
                 <div class="stat-label">Файлы</div>
             </div>
+            <div class="stat-card">
+                <div class="stat-value">${this.formatSize(stats.files_stored_size || 0)}</div>
+                <div class="stat-label">Файлы на диске (исходно ${this.formatSize(stats.files_size || 0)})</div>
+            </div>
+            ${stats.top_rooms && stats.top_rooms.length ? `
+            <div class="stat-card">
+                <div class="stat-value">${this.formatSize(stats.top_rooms[0].stored_size)}</div>
+                <div class="stat-label">Больше всего места: ${stats.top_rooms[0].name || stats.top_rooms[0].room_link}</div>
+            </div>` : ''}
         `;
     }
 
+    formatSize(bytes) {
+        const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+        let i = 0;
+        while (bytes >= 1024 && i < units.length - 1) {
+            bytes /= 1024;
+            i++;
+        }
+        return `${parseFloat(bytes.toFixed(1))} ${units[i]}`;
+    }
+
     async loadTables() {
         try {
             const response = await fetch('/api/tables');
@@ -70,6 +89,10 @@ class DatabaseViewer {
             }
 
             this.renderTables(data.tables);
+            
+            // Запрос по шардам доступен, только если они есть
+            const hasShards = data.shards && data.shards.length > 0;
+            document.getElementById('query-shards-option').style.display = hasShards ? '' : 'none';
         } catch (error) {
             this.showError('Ошибка загрузки таблиц: ' + error.message);
         }
@@ -164,6 +187,7 @@ class DatabaseViewer {
 
     async executeQuery() {
         const query = document.getElementById('sql-query').value.trim();
+        const shards = document.getElementById('query-shards').checked;
         const resultContainer = document.getElementById('query-result');
 
         if (!query) {
@@ -177,7 +201,7 @@ class DatabaseViewer {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ query })
+                body: JSON.stringify({ query, shards })
             });
 
             const result = await response.json();
@@ -0,0 +1,302 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from compression import archive_extension, open_append_writer, open_reader
+from retention import SEGMENT_INDEX_NAME, segment_lock
+
+logger = logging.getLogger(__name__)
+
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_PAUSE = 0.05  # секунды между порциями, чтобы писатели успевали захватить базу
+BACKUP_CHUNK_SIZE = 1024 * 1024
+# Микросекунды в имени: наборы, начатые в одну секунду, не совпадают
+SET_NAME_FORMAT = '%Y%m%d-%H%M%S-%f'
+SET_NAME_PATTERN = re.compile(r'^\d{8}-\d{6}(-\d{6})?$')
+MANIFEST_NAME = 'manifest.json'
+STALE_SET_AGE = 86400  # незавершенный набор старше этого оставлен упавшим процессом
+MAX_BACKUP_RESTARTS = 10
+
+
+class BackupRestarted(Exception):
+    """Копирование по порциям слишком часто начиналось заново"""
+
+
+def backup_database(source, dest, pages=BACKUP_STEP_PAGES, pause=BACKUP_STEP_PAUSE):
+    """Копирует базу SQLite через backup API порциями по pages страниц.
+
+    В режиме WAL копирование идет внутри одной читающей транзакции: снимок
+    согласован, а писатели не ждут. В режиме журнала блокировка отпускается
+    между порциями, а изменение базы другим соединением начинает копирование
+    заново; при постоянной записи после MAX_BACKUP_RESTARTS попыток база
+    копируется за один шаг.
+    """
+    src = sqlite3.connect(source, timeout=30)
+    dst = sqlite3.connect(dest)
+    try:
+        wal = src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        if wal:
+            src.execute('BEGIN')
+            src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            src.backup(dst, pages=pages)
+            src.rollback()
+        else:
+            state = {'remaining': None, 'restarts': 0}
+
+            def progress(status, remaining, total):
+                if state['remaining'] is not None and remaining > state['remaining']:
+                    state['restarts'] += 1
+                    if state['restarts'] > MAX_BACKUP_RESTARTS:
+                        raise BackupRestarted()
+                state['remaining'] = remaining
+                time.sleep(pause)
+
+            try:
+                src.backup(dst, pages=pages, progress=progress)
+            except BackupRestarted:
+                logger.warning(f"Backup of {source} keeps restarting, copying in one step")
+                src.backup(dst)
+        # Копия - самостоятельный файл без -wal
+        dst.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        dst.close()
+        src.close()
+
+
+def compress_file(source, dest):
+    """Сжимает файл; возвращает sha256 исходного содержимого"""
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f, open_append_writer(dest) as writer:
+        for chunk in iter(lambda: f.read(BACKUP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            writer.write(chunk)
+    return digest.hexdigest()
+
+
+def link_uploads(database, set_path):
+    """Закрепляет в наборе загрузки, на которые ссылается копия базы.
+
+    Загрузки не изменяются после записи, поэтому жесткая ссылка - снимок
+    файла без копирования; удаление загрузки из чата ее не затрагивает.
+    """
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone() is None:
+            return []
+        rows = [dict(row) for row in conn.execute('SELECT * FROM files ORDER BY id').fetchall()]
+    finally:
+        conn.close()
+
+    uploads = []
+    os.makedirs(os.path.join(set_path, 'uploads'), exist_ok=True)
+    for row in rows:
+        name = os.path.basename(row['file_path'])
+        target = os.path.join(set_path, 'uploads', name)
+        present = True
+        try:
+            os.link(row['file_path'], target)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            present = False
+        except OSError:
+            # Другая файловая система: жесткая ссылка невозможна
+            shutil.copy2(row['file_path'], target)
+        uploads.append({
+            'id': row['id'],
+            'room_link': row['room_link'],
+            'file_path': row['file_path'],
+            'backup_name': name,
+            'stored_size': row.get('stored_size') or row['file_size'],
+            'present': present
+        })
+    return uploads
+
+
+def copy_with_digest(src, dest):
+    """Копирует открытый файл src в dest; возвращает sha256 содержимого"""
+    digest = hashlib.sha256()
+    with open(dest, 'wb') as f:
+        for chunk in iter(lambda: src.read(BACKUP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def copy_archive(archive_folder, set_path):
+    """Копирует в набор архив сообщений (сегменты и их индексы).
+
+    Сегменты дописываются на месте, поэтому жесткая ссылка менялась бы вместе
+    с оригиналом: они копируются под совместной блокировкой, чтобы не застать
+    недописанный кадр. Индекс заменяется атомарно и копируется как есть.
+    """
+    archive = []
+    if not archive_folder or not os.path.isdir(archive_folder):
+        return archive
+    for room_link in sorted(os.listdir(archive_folder)):
+        room_path = os.path.join(archive_folder, room_link)
+        if not os.path.isdir(room_path):
+            continue
+        for name in sorted(os.listdir(room_path)):
+            if name != SEGMENT_INDEX_NAME and '.ndjson.' not in name:
+                continue
+            file = os.path.join('archive', room_link, name)
+            target = os.path.join(set_path, file)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if name == SEGMENT_INDEX_NAME:
+                with open(os.path.join(room_path, name), 'rb') as f:
+                    sha256 = copy_with_digest(f, target)
+            else:
+                with segment_lock(os.path.join(room_path, name), exclusive=False) as f:
+                    sha256 = copy_with_digest(f, target)
+            archive.append({'file': file, 'size': os.path.getsize(target), 'sha256': sha256})
+    return archive
+
+
+def list_backup_sets(folder):
+    """Завершенные наборы, от старых к новым"""
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder) if SET_NAME_PATTERN.match(name))
+
+
+def rotate_backups(folder, keep):
+    for path in list_backup_sets(folder)[:-keep]:
+        shutil.rmtree(path)
+    # Наборы, оборванные сбоем
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.endswith('.tmp') and time.time() - os.path.getmtime(path) > STALE_SET_AGE:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def create_backup(sources, folder, keep, archive_folder=None):
+    """Создает набор резервных копий и удаляет старые сверх keep.
+
+    sources: [(имя в наборе, путь к базе)]; archive_folder - архив сообщений,
+    вынесенных из баз. Набор собирается в каталоге .tmp и переименовывается,
+    только когда полностью записан.
+    """
+    set_path = os.path.join(folder, datetime.utcnow().strftime(SET_NAME_FORMAT))
+    # Рабочий каталог свой у каждого процесса; брошенные удаляет rotate_backups
+    work_path = f'{set_path}.{os.getpid()}.tmp'
+    os.makedirs(work_path)
+
+    manifest = {'created_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), 'databases': [], 'uploads': [],
+                'archive': []}
+    for name, path in sources:
+        if not os.path.exists(path):
+            continue
+        copy = os.path.join(work_path, name)
+        os.makedirs(os.path.dirname(copy), exist_ok=True)
+        started = time.time()
+        backup_database(path, copy)
+        manifest['uploads'].extend(dict(upload, database=name) for upload in link_uploads(copy, work_path))
+        compressed = copy + archive_extension()
+        sha256 = compress_file(copy, compressed)
+        manifest['databases'].append({
+            'name': name,
+            'file': os.path.relpath(compressed, work_path),
+            'size': os.path.getsize(copy),
+            'sha256': sha256,
+            'stored_size': os.path.getsize(compressed)
+        })
+        os.remove(copy)
+        logger.info(f"Backed up {path} in {time.time() - started:.1f}s")
+
+    # Архив копируется после баз: сообщение удаляется из базы только после
+    # записи в сегмент, поэтому отсутствующее в копиях баз уже есть в архиве
+    started = time.time()
+    manifest['archive'] = copy_archive(archive_folder, work_path)
+    if manifest['archive']:
+        logger.info(f"Backed up {len(manifest['archive'])} archive files in {time.time() - started:.1f}s")
+
+    with open(os.path.join(work_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.rename(work_path, set_path)
+    rotate_backups(folder, keep)
+    return set_path
+
+
+def verify_backup(set_path):
+    """Проверяет набор: контрольные суммы и integrity_check баз, архив, наличие загрузок.
+
+    Возвращает список проблем. integrity_check не замечает потерю страниц
+    в конце файла, поэтому сначала сверяются размер и sha256 копии.
+    """
+    problems = []
+    with open(os.path.join(set_path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for database in manifest['databases']:
+            copy = os.path.join(tmp, 'check.db')
+            try:
+                digest = hashlib.sha256()
+                with open_reader(os.path.join(set_path, database['file'])) as reader, open(copy, 'wb') as f:
+                    for chunk in iter(lambda: reader.read(BACKUP_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        f.write(chunk)
+                if os.path.getsize(copy) != database['size'] or digest.hexdigest() != database['sha256']:
+                    problems.append(f"{database['name']}: checksum mismatch")
+                    continue
+                conn = sqlite3.connect(copy)
+                try:
+                    result = [row[0] for row in conn.execute('PRAGMA integrity_check').fetchall()]
+                finally:
+                    conn.close()
+                if result != ['ok']:
+                    problems.append(f"{database['name']}: {'; '.join(result)}")
+            except Exception as e:
+                problems.append(f"{database['name']}: {e}")
+            finally:
+                if os.path.exists(copy):
+                    os.remove(copy)
+
+    # Наборы, созданные до копирования архива, не содержат ключа archive
+    for archived in manifest.get('archive', []):
+        path = os.path.join(set_path, archived['file'])
+        if not os.path.exists(path):
+            problems.append(f"{archived['file']}: missing")
+            continue
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(BACKUP_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        if os.path.getsize(path) != archived['size'] or digest.hexdigest() != archived['sha256']:
+            problems.append(f"{archived['file']}: checksum mismatch")
+
+    for upload in manifest['uploads']:
+        if not upload['present']:
+            continue
+        path = os.path.join(set_path, 'uploads', upload['backup_name'])
+        if not os.path.exists(path):
+            problems.append(f"upload {upload['file_path']}: missing")
+        elif os.path.getsize(path) != upload['stored_size']:
+            problems.append(f"upload {upload['file_path']}: size mismatch")
+    return problems
+
+
+def start_backup_worker(get_sources, folder, keep, interval, archive_folder=None):
+    """Запускает фоновый поток, периодически создающий набор резервных копий"""
+    stop_event = threading.Event()
+
+    def worker():
+        while not stop_event.wait(interval):
+            try:
+                create_backup(get_sources(), folder, keep, archive_folder)
+            except Exception as e:
+                logger.error(f"Backup job error: {e}")
+
+    thread = threading.Thread(target=worker, name='backup-worker', daemon=True)
+    thread.start()
+    return stop_event
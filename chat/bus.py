@@ -0,0 +1,364 @@
+import json
+import logging
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1.0
+# Сколько событий UnixSocketBus копит без соединения с брокером
+PENDING_LIMIT = 10000
+
+# Событие reset означает, что часть событий могла быть потеряна
+# (разрыв соединения с брокером), и подписчики должны сбросить состояние
+RESET_EVENT = {'type': 'reset'}
+
+
+class Bus:
+    """Шина событий о новых сообщениях и файлах.
+
+    shared = True означает, что шина доставляет события всех процессов,
+    и подписчик может отвечать на запросы из памяти.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, event):
+        raise NotImplementedError
+
+    def _dispatch(self, event):
+        for callback in list(self._subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Bus subscriber error: {e}")
+
+
+class LocalBus(Bus):
+    """Шина внутри одного процесса.
+
+    Если приложение запущено единственным процессом (SINGLE_PROCESS),
+    локальная шина видит все записи и считается общей.
+    """
+
+    def __init__(self, shared=False):
+        super().__init__()
+        self.shared = shared
+
+    def publish(self, event):
+        self._dispatch(event)
+
+
+class UnixSocketBus(Bus):
+    """Клиент брокера на Unix-сокете (см. run_broker).
+
+    События, опубликованные без соединения, копятся и отправляются после
+    переподключения; если очередь переполнилась, вместо потерянных событий
+    всем процессам рассылается reset.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._sock = None
+        self._pending = deque()
+        self._overflow = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._read_loop, name='bus-reader', daemon=True)
+        self._thread.start()
+
+    @property
+    def shared(self):
+        # Пока соединения нет, события других процессов сюда не доходят
+        return self._sock is not None
+
+    def publish(self, event):
+        data = json.dumps(event).encode('utf-8') + b'\n'
+        with self._lock:
+            if self._sock is not None:
+                try:
+                    self._sock.sendall(data)
+                    return
+                except OSError as e:
+                    logger.error(f"Bus publish error: {e}")
+                    self._sock.close()
+                    self._sock = None
+            if len(self._pending) >= PENDING_LIMIT:
+                self._pending.clear()
+                self._overflow = True
+            self._pending.append(data)
+
+    def _flush(self, sock):
+        if self._overflow:
+            sock.sendall(json.dumps(RESET_EVENT).encode('utf-8') + b'\n')
+            self._overflow = False
+        while self._pending:
+            sock.sendall(self._pending[0])
+            self._pending.popleft()
+
+    def _read_loop(self):
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                with self._lock:
+                    self._flush(sock)
+                    self._sock = sock
+                self._dispatch(RESET_EVENT)
+
+                reader = sock.makefile('rb')
+                for line in reader:
+                    self._dispatch(json.loads(line))
+            except OSError as e:
+                logger.error(f"Bus connection error: {e}")
+            with self._lock:
+                self._sock = None
+            sock.close()
+            self._dispatch(RESET_EVENT)
+            time.sleep(RECONNECT_DELAY)
+
+
+class RetryingPublisher:
+    """Повторная отправка событий, которые брокер не принял.
+
+    Пока очередь не пуста, другие процессы могли не получить событие: шина не
+    считается общей, а свои подписчики получают reset. Отправка повторяется при
+    следующей публикации и по таймеру; если очередь переполнилась, вместо
+    потерянных событий рассылается reset.
+    """
+
+    def _init_pending(self):
+        self._pending = deque()
+        self._overflow = False
+        self._pending_lock = threading.Lock()
+        self._retry_timer = None
+
+    @property
+    def _delivered(self):
+        return not self._pending and not self._overflow
+
+    def _send(self, event):
+        raise NotImplementedError
+
+    def _publish_pending(self, event):
+        with self._pending_lock:
+            if len(self._pending) >= PENDING_LIMIT:
+                self._pending.clear()
+                self._overflow = True
+            self._pending.append(event)
+        self._flush()
+
+    def _flush(self):
+        with self._pending_lock:
+            self._retry_timer = None
+            try:
+                if self._overflow:
+                    self._send(RESET_EVENT)
+                    self._overflow = False
+                while self._pending:
+                    self._send(self._pending[0])
+                    self._pending.popleft()
+                return
+            except Exception as e:
+                logger.error(f"Bus publish error: {e}")
+                self._retry_timer = threading.Timer(RECONNECT_DELAY, self._flush)
+                self._retry_timer.daemon = True
+                self._retry_timer.start()
+        self._dispatch(RESET_EVENT)
+
+
+class RedisBus(RetryingPublisher, Bus):
+    """Шина на Redis pub/sub"""
+
+    def __init__(self, url, channel='chat_events'):
+        # Импорт redis занимает десятки миллисекунд, поэтому только для этого бэкенда
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('redis is not installed')
+        super().__init__()
+        self.redis = redis
+        self.channel = channel
+        self.client = redis.Redis.from_url(url)
+        self._subscribed = False
+        self._init_pending()
+        self._thread = threading.Thread(target=self._read_loop, name='bus-reader', daemon=True)
+        self._thread.start()
+
+    @property
+    def shared(self):
+        # Без подписки не видны чужие события, с неотправленными - другим не видны свои
+        return self._subscribed and self._delivered
+
+    def publish(self, event):
+        self._publish_pending(event)
+
+    def _send(self, event):
+        self.client.publish(self.channel, json.dumps(event))
+
+    def _read_loop(self):
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                self._subscribed = True
+                self._dispatch(RESET_EVENT)
+                for message in pubsub.listen():
+                    self._dispatch(json.loads(message['data']))
+            except self.redis.RedisError as e:
+                logger.error(f"Bus connection error: {e}")
+            finally:
+                self._subscribed = False
+                pubsub.close()
+            self._dispatch(RESET_EVENT)
+            time.sleep(RECONNECT_DELAY)
+
+
+class PostgresBus(RetryingPublisher, Bus):
+    """Шина поверх LISTEN/NOTIFY хранилища PostgreSQL.
+
+    О новых сообщениях, файлах и завершении их обработки хранилище уведомляет
+    само в транзакции записи (без содержимого), остальные события отправляются
+    отдельно: ошибка такой отправки не отменяет уже зафиксированную запись.
+    """
+
+    def __init__(self, storage):
+        super().__init__()
+        self.storage = storage
+        self._init_pending()
+        storage.add_listener(self._dispatch)
+
+    @property
+    def shared(self):
+        return self.storage.listening and self._delivered
+
+    def publish(self, event):
+        if event['type'] in ('message', 'file', 'file_processed'):
+            return
+        self._publish_pending(event)
+
+    def _send(self, event):
+        self.storage.publish(event)
+
+
+class RoomEvents:
+    """Списки файлов комнат, известные по событиям шины.
+
+    Список (ответ /get_files вместе с занятым местом) читается из базы при
+    первом обращении и сбрасывается событием о новом или удаленном файле комнаты.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        self._files_versions = {}
+        self._epoch = 0
+
+    def handle(self, event):
+        with self._lock:
+            if event['type'] == 'reset':
+                self._files.clear()
+                self._epoch += 1
+            elif event['type'] in ('file', 'file_deleted', 'file_processed'):
+                room_link = event['room_link']
+                self._files.pop(room_link, None)
+                self._files_versions[room_link] = self._files_versions.get(room_link, 0) + 1
+
+    def get_files(self, room_link):
+        with self._lock:
+            return self._files.get(room_link)
+
+    def files_version(self, room_link):
+        """Версия списка файлов; берется до чтения базы и передается в set_files"""
+        with self._lock:
+            return self._epoch, self._files_versions.get(room_link, 0)
+
+    def set_files(self, room_link, files, version):
+        with self._lock:
+            # Список сохраняем, только если за время чтения не было событий
+            if version == (self._epoch, self._files_versions.get(room_link, 0)):
+                self._files[room_link] = files
+
+
+def create_bus(config, storage=None):
+    """Создает шину по настройке BUS_BACKEND"""
+    backend = config.get('BUS_BACKEND', 'local')
+    if backend == 'local':
+        return LocalBus(shared=config.get('SINGLE_PROCESS', False))
+    if backend == 'unix':
+        return UnixSocketBus(config['BUS_SOCKET'])
+    if backend == 'redis':
+        return RedisBus(config['REDIS_URL'])
+    if backend == 'postgres':
+        return PostgresBus(storage)
+    raise ValueError(f"Unknown bus backend: {backend}")
+
+
+def run_broker(path):
+    """Брокер: рассылает каждую строку, полученную от клиента, всем клиентам"""
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    server.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    buffers = {}
+
+    def drop(client):
+        if client not in buffers:
+            return
+        selector.unregister(client)
+        buffers.pop(client, None)
+        client.close()
+
+    logger.info(f"Bus broker listening on {path}")
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is server:
+                client, _ = server.accept()
+                # Медленный клиент не должен останавливать рассылку остальным
+                client.settimeout(1.0)
+                selector.register(client, selectors.EVENT_READ)
+                buffers[client] = b''
+                continue
+
+            client = key.fileobj
+            try:
+                data = client.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                drop(client)
+                continue
+
+            if client not in buffers:
+                continue
+            buffers[client] += data
+            *lines, buffers[client] = buffers[client].split(b'\n')
+            for line in lines:
+                if not line:
+                    continue
+                for target in list(buffers):
+                    try:
+                        target.sendall(line + b'\n')
+                    except OSError:
+                        drop(target)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    run_broker(sys.argv[1] if len(sys.argv) > 1 else '/tmp/chat-bus.sock')
@@ -0,0 +1,74 @@
+import gzip
+import io
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_LEVEL = 3
+
+# Загрузка сжимается, если образец из ее начала ужался хотя бы на 10%
+UPLOAD_SAMPLE_SIZE = 256 * 1024
+MIN_COMPRESS_SIZE = 4096
+MAX_COMPRESSED_RATIO = 0.9
+
+
+def archive_extension():
+    """Расширение для новых сжатых сегментов: zstd, если доступен, иначе gzip"""
+    return '.zst' if zstandard else '.gz'
+
+
+def open_append_writer(path, level=ZSTD_LEVEL):
+    """Открывает файл на дозапись нового сжатого кадра.
+
+    И zstd, и gzip допускают склейку независимых кадров в одном файле,
+    поэтому каждая запись просто добавляет кадр в конец сегмента.
+    """
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed')
+        raw = open(path, 'ab')
+        return zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=True)
+    return gzip.open(path, 'ab')
+
+
+def open_reader(path):
+    """Открывает сжатый файл на чтение в бинарном режиме"""
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed')
+        raw = open(path, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    return gzip.open(path, 'rb')
+
+
+def is_compressible(sample, level=ZSTD_LEVEL):
+    """Решает по образцу данных, стоит ли сжимать файл целиком"""
+    if zstandard is None or len(sample) < MIN_COMPRESS_SIZE:
+        return False
+    compressed = zstandard.ZstdCompressor(level=level).compress(sample)
+    return len(compressed) <= len(sample) * MAX_COMPRESSED_RATIO
+
+
+def compress_stream(head, source, dest, chunk_size, level=ZSTD_LEVEL):
+    """Сжимает head и остаток потока source в dest; возвращает исходный размер"""
+    size = 0
+    with zstandard.ZstdCompressor(level=level).stream_writer(dest, closefd=False) as writer:
+        writer.write(head)
+        size += len(head)
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            writer.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def open_stored(path, encoding=None):
+    """Открывает сохраненную загрузку на чтение исходных байтов"""
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is not installed')
+        raw = open(path, 'rb')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+    return open(path, 'rb')
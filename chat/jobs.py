@@ -0,0 +1,195 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30  # секунды; растет с каждой попыткой
+STALE_TIMEOUT = 600  # задача в работе дольше этого считается брошенной
+DONE_TTL = 86400  # выполненные задачи хранятся сутки
+
+
+class JobQueue:
+    """Очередь задач в отдельной базе SQLite.
+
+    Задача захватывается одним UPDATE ... RETURNING, поэтому очередь
+    безопасно разбирают несколько потоков и процессов. Задачи упавшего
+    обработчика возвращаются в очередь по таймауту (requeue_stale).
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._wakeup = threading.Event()
+
+    def connect(self):
+        conn = sqlite3.connect(self.database, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init_schema(self):
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_after REAL NOT NULL,
+                locked_at REAL,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, run_after)')
+        conn.commit()
+        conn.close()
+
+    def enqueue(self, kind, payload):
+        conn = self.connect()
+        try:
+            with conn:
+                job_id = conn.execute('INSERT INTO jobs (kind, payload, run_after) VALUES (?, ?, ?)',
+                                      (kind, json.dumps(payload), time.time())).lastrowid
+        finally:
+            conn.close()
+        self.wake()
+        return job_id
+
+    def claim(self):
+        """Захватывает следующую готовую задачу или возвращает None"""
+        now = time.time()
+        conn = self.connect()
+        try:
+            with conn:
+                row = conn.execute('''
+                    UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_at = ?
+                    WHERE id = (
+                        SELECT id FROM jobs WHERE status = 'pending' AND run_after <= ?
+                        ORDER BY id LIMIT 1
+                    )
+                    RETURNING id, kind, payload, attempts
+                ''', (now, now)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+
+    def complete(self, job_id):
+        # run_after выполненной задачи - время завершения, от него считается DONE_TTL
+        self._update('UPDATE jobs SET status = ?, locked_at = NULL, last_error = NULL, run_after = ? WHERE id = ?',
+                     ('done', time.time(), job_id))
+
+    def fail(self, job, error):
+        if job['attempts'] >= MAX_ATTEMPTS:
+            self._update('UPDATE jobs SET status = ?, locked_at = NULL, last_error = ? WHERE id = ?',
+                         ('failed', str(error), job['id']))
+            return
+        self._update('''
+            UPDATE jobs SET status = 'pending', locked_at = NULL, last_error = ?, run_after = ?
+            WHERE id = ?
+        ''', (str(error), time.time() + RETRY_DELAY * job['attempts'], job['id']))
+
+    def requeue_stale(self, timeout=STALE_TIMEOUT):
+        """Возвращает в очередь зависшие задачи и удаляет старые выполненные"""
+        now = time.time()
+        conn = self.connect()
+        try:
+            with conn:
+                requeued = conn.execute('''
+                    UPDATE jobs SET status = 'pending', locked_at = NULL
+                    WHERE status = 'running' AND locked_at < ?
+                ''', (now - timeout,)).rowcount
+                conn.execute("DELETE FROM jobs WHERE status = 'done' AND run_after < ?", (now - DONE_TTL,))
+        finally:
+            conn.close()
+        return requeued
+
+    def stats(self):
+        conn = self.connect()
+        try:
+            rows = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        finally:
+            conn.close()
+        return {status: count for status, count in rows}
+
+    def wake(self):
+        self._wakeup.set()
+
+    def wait(self, timeout):
+        """Ждет новую задачу этого процесса не дольше timeout секунд"""
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def _update(self, query, params):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(query, params)
+        finally:
+            conn.close()
+
+
+class WorkerPool:
+    """Пул потоков, выполняющих задачи очереди.
+
+    handlers: {kind: функция(payload)}. Исключение обработчика означает
+    неудачную попытку; задача будет повторена с задержкой.
+    """
+
+    def __init__(self, queue, handlers, workers=2, poll_interval=5.0):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self.queue.requeue_stale()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.queue.wake()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        last_maintenance = time.time()
+        while not self._stop.is_set():
+            if time.time() - last_maintenance > STALE_TIMEOUT:
+                last_maintenance = time.time()
+                self.queue.requeue_stale()
+
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                logger.error(f"Job queue error: {e}")
+                job = None
+            if job is None:
+                self.queue.wait(self.poll_interval)
+                continue
+
+            handler = self.handlers.get(job['kind'])
+            try:
+                if handler is None:
+                    raise ValueError(f"Unknown job kind: {job['kind']}")
+                handler(job['payload'])
+                self.queue.complete(job['id'])
+            except Exception as e:
+                logger.error(f"Job {job['id']} ({job['kind']}) failed: {e}")
+                self.queue.fail(job, e)
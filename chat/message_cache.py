@@ -0,0 +1,186 @@
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+# Примерные накладные расходы на одно сообщение в памяти, байт
+MESSAGE_OVERHEAD = 200
+
+
+class RoomRing:
+    """Кольцевой буфер последних сообщений комнаты.
+
+    id хранятся в массиве array('q'), сериализованные сообщения - в списке
+    той же длины. Буфер содержит все сообщения комнаты с id > floor.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ids = array('q', bytes(8 * capacity))
+        self.sizes = array('q', bytes(8 * capacity))
+        self.items = [None] * capacity
+        self.start = 0
+        self.count = 0
+        self.floor = 0
+        self.pending = 0  # наибольший id, о котором сообщила шина
+        self.nbytes = 0
+        self.cold = True
+        self.lock = threading.Lock()
+
+    @property
+    def newest(self):
+        if not self.count:
+            return self.floor
+        return self.ids[(self.start + self.count - 1) % self.capacity]
+
+    def append(self, message, size):
+        """Добавляет сообщение с id больше newest; возвращает изменение объема"""
+        freed = 0
+        if self.count == self.capacity:
+            self.floor = self.ids[self.start]
+            freed = self.sizes[self.start]
+            self.items[self.start] = None
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+
+        index = (self.start + self.count) % self.capacity
+        self.ids[index] = message['id']
+        self.sizes[index] = size
+        self.items[index] = message
+        self.count += 1
+        self.nbytes += size - freed
+        return size - freed
+
+    def since(self, last_id):
+        """Сообщения с id > last_id или None, если last_id старше окна буфера"""
+        if last_id < self.floor:
+            return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ids[(self.start + mid) % self.capacity] <= last_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return [self.items[(self.start + i) % self.capacity] for i in range(lo, self.count)]
+
+
+class MessageCache:
+    """Буферы последних сообщений активных комнат с вытеснением LRU.
+
+    Буфер пополняется только чтением из базы по возрастанию id: события шины
+    и отправка сообщения лишь помечают буфер устаревшим, и следующий запрос
+    один раз дочитывает новые строки. Так порядок id в буфере совпадает с
+    порядком в базе, даже если события разных процессов пришли вразнобой.
+    """
+
+    def __init__(self, serialize, room_capacity, max_rooms, max_bytes):
+        self.serialize = serialize
+        self.room_capacity = room_capacity
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.evictions = 0
+
+    def handle(self, event):
+        with self._lock:
+            if event['type'] == 'reset':
+                self._rooms.clear()
+                self.nbytes = 0
+            elif event['type'] == 'message':
+                ring = self._rooms.get(event['room_link'])
+                if ring is not None:
+                    message_id = event['message']['id'] if 'message' in event else event['id']
+                    ring.pending = max(ring.pending, message_id)
+
+    def get_messages(self, room_link, last_id, storage):
+        """Сообщения комнаты с id > last_id или None, если ответить из памяти нельзя"""
+        with self._lock:
+            ring = self._rooms.get(room_link)
+            if ring is None:
+                # Буфер регистрируется до чтения базы, чтобы не пропустить
+                # событие о сообщении, записанном во время прогрева
+                ring = RoomRing(self.room_capacity)
+                self._rooms[room_link] = ring
+            else:
+                self._rooms.move_to_end(room_link)
+
+        with ring.lock:
+            if ring.cold:
+                if not self._warm(room_link, ring, storage):
+                    with self._lock:
+                        if self._rooms.get(room_link) is ring:
+                            del self._rooms[room_link]
+                    return None
+            elif ring.pending > ring.newest:
+                self._refresh(room_link, ring, storage)
+            messages = ring.since(last_id)
+
+        with self._lock:
+            if messages is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return messages
+
+    def refresh(self, room_link, storage, message_id):
+        """Дочитывает в буфер сообщение, только что записанное этим процессом"""
+        with self._lock:
+            ring = self._rooms.get(room_link)
+            if ring is None:
+                return
+            ring.pending = max(ring.pending, message_id)
+        with ring.lock:
+            if not ring.cold and ring.pending > ring.newest:
+                self._refresh(room_link, ring, storage)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'rooms': len(self._rooms),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'fills': self.fills,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else None
+            }
+
+    def _warm(self, room_link, ring, storage):
+        if not storage.get_room(room_link):
+            return False
+        messages = storage.get_history(room_link, sys.maxsize, self.room_capacity)
+        # Если комната длиннее буфера, более старые сообщения в нем отсутствуют
+        if len(messages) == self.room_capacity:
+            ring.floor = messages[0]['id'] - 1
+        self._fill(room_link, ring, messages)
+        ring.cold = False
+        return True
+
+    def _refresh(self, room_link, ring, storage):
+        # Хранилище фиксирует сообщения комнаты по возрастанию id
+        # (_lock_room_messages), поэтому после ring.newest ничего не пропущено
+        self._fill(room_link, ring, storage.get_messages(room_link, ring.newest))
+
+    def _fill(self, room_link, ring, messages):
+        delta = 0
+        for msg in messages:
+            message = self.serialize(msg)
+            delta += ring.append(message, len(message['message']) + len(message['username']) + MESSAGE_OVERHEAD)
+        with self._lock:
+            self.fills += 1
+            if self._rooms.get(room_link) is ring:
+                self.nbytes += delta
+                self._evict()
+
+    def _evict(self):
+        while self._rooms and (len(self._rooms) > self.max_rooms or self.nbytes > self.max_bytes):
+            _, ring = self._rooms.popitem(last=False)
+            self.nbytes -= ring.nbytes
+            self.evictions += 1
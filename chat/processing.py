@@ -0,0 +1,155 @@
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+
+from compression import open_stored
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+SNIFF_SIZE = 512
+THUMBNAIL_SIZES = (128, 512)
+
+# Сигнатуры распространенных форматов: (смещение, байты, MIME-тип)
+SIGNATURES = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'\x28\xb5\x2f\xfd', 'application/zstd'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (0, b'SQLite format 3\x00', 'application/vnd.sqlite3'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+    (4, b'ftyp', 'video/mp4'),
+]
+
+
+def open_upload(file_record):
+    """Открывает загрузку на чтение исходных (несжатых) байтов"""
+    return open_stored(file_record['file_path'], file_record['encoding'])
+
+
+def sha256_file(file_record):
+    digest = hashlib.sha256()
+    with open_upload(file_record) as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sniff_mime_type(file_record):
+    """MIME-тип по первым байтам файла, затем по расширению имени"""
+    with open_upload(file_record) as f:
+        head = f.read(SNIFF_SIZE)
+    filename = file_record['original_filename']
+
+    for offset, signature, mime_type in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return mime_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'audio/wav'
+
+    guessed, _ = mimetypes.guess_type(filename)
+    if guessed:
+        return guessed
+    try:
+        head.decode('utf-8')
+        return 'text/plain'
+    except UnicodeDecodeError:
+        return 'application/octet-stream'
+
+
+def thumbnail_format():
+    if Image is not None and features.check('webp'):
+        return 'WEBP', '.webp'
+    return 'PNG', '.png'
+
+
+def thumbnail_key(file_record):
+    # Имя по uuid сохраненного файла: id файлов в разных шардах повторяются
+    return os.path.splitext(file_record['filename'])[0]
+
+
+def thumbnail_path(folder, key, size):
+    return os.path.join(folder, f"{key}_{size}{thumbnail_format()[1]}")
+
+
+def make_thumbnails(file_record, folder, sizes=THUMBNAIL_SIZES):
+    """Создает миниатюры изображения; возвращает список созданных размеров"""
+    if Image is None:
+        return []
+
+    # Pillow нужен файл с произвольным доступом, сжатую загрузку читаем в память
+    source = file_record['file_path']
+    if file_record['encoding']:
+        with open_upload(file_record) as f:
+            source = io.BytesIO(f.read())
+
+    key = thumbnail_key(file_record)
+    image_format, _ = thumbnail_format()
+    os.makedirs(folder, exist_ok=True)
+    created = []
+    with Image.open(source) as image:
+        # JPEG декодируется сразу в уменьшенном масштабе
+        image.draft('RGB', (max(sizes), max(sizes)))
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        # От большего размера к меньшему; thumbnail не увеличивает изображение
+        for size in sorted(sizes, reverse=True):
+            image.thumbnail((size, size))
+            target = thumbnail_path(folder, key, size)
+            # Запись во временный файл, чтобы не отдать недописанную миниатюру
+            image.save(target + '.tmp', image_format)
+            os.replace(target + '.tmp', target)
+            created.append(size)
+    return sorted(created)
+
+
+def remove_thumbnails(folder, file_record, sizes=THUMBNAIL_SIZES):
+    for size in sizes:
+        try:
+            os.remove(thumbnail_path(folder, thumbnail_key(file_record), size))
+        except FileNotFoundError:
+            pass
+
+
+def process_upload(storage, thumbnail_folder, file_id, room_link=None):
+    """Вычисляет хеш, MIME-тип и миниатюры загруженного файла.
+
+    Возвращает False, если файл уже удален.
+    """
+    file_record = storage.get_file(file_id, room_link)
+    if not file_record or not os.path.exists(file_record['file_path']):
+        return False
+
+    sha256 = sha256_file(file_record)
+    mime_type = sniff_mime_type(file_record)
+
+    thumbnails = []
+    if mime_type.startswith('image/'):
+        try:
+            thumbnails = make_thumbnails(file_record, thumbnail_folder)
+        except Exception as e:
+            # Поврежденное или неподдерживаемое изображение - просто без миниатюр
+            logger.error(f"Thumbnail error for file {file_id}: {e}")
+
+    storage.set_file_metadata(file_id, file_record['room_link'], sha256, mime_type, thumbnails)
+    return True
@@ -0,0 +1,153 @@
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_MEMORY_KEYS = 100000  # сверх этого из памяти удаляются заполненные корзины
+
+
+class MemoryLimiter:
+    """Корзины токенов в памяти процесса.
+
+    hit проверяет сразу несколько корзин и списывает токены, только если
+    их хватает во всех: отказ по IP не тратит бюджет пользователя.
+    """
+
+    def __init__(self, max_keys=MAX_MEMORY_KEYS):
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, updated, full_at)
+        self._lock = threading.Lock()
+
+    def hit(self, buckets, cost=1):
+        """buckets: [(key, rate, burst)]. Возвращает 0 или секунды до повтора"""
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            retry_after = 0
+            for key, rate, burst in buckets:
+                tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                if tokens < cost:
+                    retry_after = max(retry_after, (cost - tokens) / rate)
+                states.append((key, rate, burst, tokens))
+            if retry_after:
+                return retry_after
+
+            for key, rate, burst, tokens in states:
+                tokens -= cost
+                self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return 0
+
+    def _prune(self, now):
+        # Заполненная корзина ничем не отличается от отсутствующей
+        for key in [key for key, state in self._buckets.items() if state[2] <= now]:
+            del self._buckets[key]
+
+
+# Все корзины проверяются и списываются одним атомарным скриптом.
+# Время берется с сервера Redis, чтобы часы процессов не расходились.
+REDIS_HIT_SCRIPT = '''
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local states = {}
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if tokens < cost then
+        retry_after = math.max(retry_after, (cost - tokens) / rate)
+    end
+    states[i] = tokens
+end
+if retry_after > 0 then
+    return tostring(retry_after)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', states[i] - cost, 'updated', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return '0'
+'''
+
+
+class RedisLimiter:
+    """Корзины токенов в Redis, общие для всех процессов и хостов.
+
+    При недоступности Redis запросы пропускаются: ограничитель не должен
+    останавливать чат.
+    """
+
+    def __init__(self, url, prefix='ratelimit:'):
+        # Импорт redis занимает десятки миллисекунд, поэтому только для этого бэкенда
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('redis is not installed')
+        self.redis = redis
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+        self._script = self.client.register_script(REDIS_HIT_SCRIPT)
+
+    def hit(self, buckets, cost=1):
+        keys = [self.prefix + key for key, _, _ in buckets]
+        args = [cost]
+        for _, rate, burst in buckets:
+            args.extend((rate, burst))
+        try:
+            return float(self._script(keys=keys, args=args))
+        except self.redis.RedisError as e:
+            logger.error(f"Rate limiter error: {e}")
+            return 0
+
+
+class ConcurrencyLimiter:
+    """Ограничение числа одновременно выполняемых запросов в процессе"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def try_acquire(self):
+        return self._semaphore.acquire(blocking=False)
+
+    def release(self):
+        self._semaphore.release()
+
+
+def create_limiter(config):
+    """Создает ограничитель по настройке RATE_LIMIT_BACKEND"""
+    backend = config.get('RATE_LIMIT_BACKEND', 'memory')
+    if backend == 'memory':
+        return MemoryLimiter()
+    if backend == 'redis':
+        return RedisLimiter(config['REDIS_URL'])
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+def route_buckets(route, budgets, identities):
+    """Корзины маршрута: budgets {scope: (rate, burst)}, identities {scope: значение}.
+
+    Области без значения (например, комната не указана) пропускаются.
+    """
+    buckets = []
+    for scope, (rate, burst) in budgets.items():
+        value = identities.get(scope)
+        if value is not None:
+            buckets.append((f"{route}:{scope}:{value}", rate, burst))
+    return buckets
+
+
+def retry_after_header(seconds):
+    # Retry-After - целое число секунд, не меньше одной
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,203 @@
+import glob
+import json
+import logging
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from compression import archive_extension, open_append_writer, open_reader
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BATCH_SIZE = 5000
+# Диапазоны id сегментов комнаты: {имя сегмента: [min_id, max_id]}
+SEGMENT_INDEX_NAME = 'index.json'
+
+
+def segment_path(folder, room_link, month):
+    """Путь к архивному сегменту комнаты за месяц (YYYY-MM)"""
+    return os.path.join(folder, room_link, f"{month}.ndjson{archive_extension()}")
+
+
+def list_segments(folder, room_link):
+    """Сегменты комнаты, от новых к старым"""
+    paths = glob.glob(os.path.join(folder, room_link, '*.ndjson.*'))
+    return sorted(paths, reverse=True)
+
+
+@contextmanager
+def segment_lock(path, exclusive):
+    """Блокирует сегмент: дозапись - монопольно, копирование - совместно.
+
+    Отдает открытый файл (на дозапись или чтение). Без fcntl (Windows)
+    блокировка не выполняется.
+    """
+    with open(path, 'ab' if exclusive else 'rb') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield f
+
+
+def load_segment_index(folder, room_link):
+    try:
+        with open(os.path.join(folder, room_link, SEGMENT_INDEX_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_segment_index(folder, room_link, index):
+    path = os.path.join(folder, room_link, SEGMENT_INDEX_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+
+def scan_segment_range(path):
+    """[min_id, max_id] сегмента по его содержимому"""
+    with open_reader(path) as reader:
+        ids = [json.loads(line)['id'] for line in reader if line.strip()]
+    return [min(ids), max(ids)] if ids else None
+
+
+def segment_ranges(folder, room_link):
+    """Пары (путь, [min_id, max_id]) от новых сегментов к старым.
+
+    Сегменты без записи в индексе (архив до появления индекса или сбой
+    между записью сегмента и индекса) читаются один раз и дописываются в индекс.
+    """
+    index = load_segment_index(folder, room_link)
+    changed = False
+    ranges = []
+    for path in list_segments(folder, room_link):
+        name = os.path.basename(path)
+        if name not in index:
+            index[name] = scan_segment_range(path)
+            changed = True
+        ranges.append((path, index[name]))
+    if changed:
+        save_segment_index(folder, room_link, index)
+    return ranges
+
+
+def append_to_archive(folder, room_link, rows):
+    """Дописывает сообщения в сегменты, сгруппированные по месяцам"""
+    by_month = {}
+    for row in rows:
+        month = str(row['timestamp'])[:7]
+        by_month.setdefault(month, []).append(row)
+
+    os.makedirs(os.path.join(folder, room_link), exist_ok=True)
+    index = load_segment_index(folder, room_link)
+    for month, month_rows in by_month.items():
+        path = segment_path(folder, room_link, month)
+        name = os.path.basename(path)
+        # Сегмент, записанный до появления индекса, сначала учитываем целиком
+        if name not in index and os.path.exists(path):
+            index[name] = scan_segment_range(path)
+        # Резервное копирование не должно застать недописанный кадр
+        with segment_lock(path, exclusive=True), open_append_writer(path) as writer:
+            for row in month_rows:
+                writer.write(json.dumps(row, ensure_ascii=False).encode('utf-8') + b'\n')
+        ids = [row['id'] for row in month_rows] + (index.get(name) or [])
+        index[name] = [min(ids), max(ids)]
+    # Индекс пишется после сегментов: при сбое между ними граница min_id
+    # сегмента остается верной, а max_id только занижается
+    save_segment_index(folder, room_link, index)
+
+
+def read_archived_messages(folder, room_link, before_id, limit):
+    """Возвращает до limit архивных сообщений с id < before_id по возрастанию id"""
+    collected = []
+    seen = set()
+    for path, id_range in segment_ranges(folder, room_link):
+        # Сегменты целиком новее страницы не распаковываются
+        if id_range is None or id_range[0] >= before_id:
+            continue
+        window = deque(maxlen=limit)
+        with open_reader(path) as reader:
+            for line in reader:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                # Повторная архивация одной строки возможна при сбое до COMMIT
+                if row['id'] >= before_id or row['id'] in seen:
+                    continue
+                seen.add(row['id'])
+                window.append(row)
+        collected = sorted(window, key=lambda r: r['id']) + collected
+        if len(collected) >= limit:
+            break
+    return collected[-limit:]
+
+
+def get_retention_policy(storage, room_link, defaults):
+    """Политика хранения комнаты с учетом глобальных значений по умолчанию"""
+    row = storage.get_retention_policy(room_link)
+    max_age_days = defaults.get('max_age_days')
+    max_messages = defaults.get('max_messages')
+    if row:
+        if row['max_age_days'] is not None:
+            max_age_days = row['max_age_days']
+        if row['max_messages'] is not None:
+            max_messages = row['max_messages']
+    return max_age_days, max_messages
+
+
+def archive_room(storage, folder, room_link, cutoff_id, batch_size=ARCHIVE_BATCH_SIZE):
+    """Переносит сообщения с id <= cutoff_id в архив порциями.
+
+    Строки удаляются только после записи в сегмент и строго по списку id,
+    поэтому сбой между шагами может лишь продублировать строку в архиве.
+    """
+    archived = 0
+    while True:
+        rows = storage.get_messages_upto(room_link, cutoff_id, batch_size)
+        if not rows:
+            break
+        append_to_archive(folder, room_link, rows)
+        storage.delete_messages(room_link, [row['id'] for row in rows])
+        archived += len(rows)
+        if len(rows) < batch_size:
+            break
+    return archived
+
+
+def run_retention(storage, folder, defaults):
+    """Один проход задачи хранения по всем комнатам"""
+    all_rooms = bool(defaults.get('max_age_days') or defaults.get('max_messages'))
+    archived = 0
+    freed = 0
+    for room_link in storage.list_retention_rooms(all_rooms):
+        max_age_days, max_messages = get_retention_policy(storage, room_link, defaults)
+        cutoff_id = storage.find_retention_cutoff(room_link, max_age_days, max_messages)
+        if not cutoff_id:
+            continue
+        count = archive_room(storage, folder, room_link, cutoff_id)
+        if count:
+            logger.info(f"Archived {count} messages from room {room_link}")
+            archived += count
+            freed += storage.compact(room_link)
+    return {'archived': archived, 'freed_pages': freed}
+
+
+def start_retention_worker(storage, folder, defaults, interval):
+    """Запускает фоновый поток, периодически выполняющий run_retention"""
+    stop_event = threading.Event()
+
+    def worker():
+        while not stop_event.wait(interval):
+            try:
+                run_retention(storage, folder, defaults)
+            except Exception as e:
+                logger.error(f"Retention job error: {e}")
+
+    thread = threading.Thread(target=worker, name='retention-worker', daemon=True)
+    thread.start()
+    return stop_event
@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+import tarfile
+import time
+import zipfile
+from datetime import datetime
+
+from compression import open_reader, open_stored
+from retention import list_segments
+
+logger = logging.getLogger(__name__)
+
+EXPORT_VERSION = 1
+EXPORT_FORMATS = ('zip', 'tar')
+EXPORT_MIMETYPES = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+EXPORT_CHUNK_SIZE = 1024 * 1024
+MESSAGE_PART_SIZE = 10000  # сообщений в одном файле messages/NNNNNN.ndjson
+IMPORT_BATCH_SIZE = 50000  # сообщений в одной транзакции загрузки
+
+MESSAGE_FIELDS = ('id', 'user_id', 'username', 'message', 'timestamp')
+FILE_FIELDS = ('id', 'user_id', 'username', 'filename', 'original_filename', 'file_size', 'file_type',
+               'upload_date', 'sha256', 'mime_type')
+
+# Пароль импортированных пользователей: ни один хеш PBKDF2 с ним не совпадет
+UNUSABLE_PASSWORD = '!'
+
+
+class StreamSink:
+    """Файлоподобный приемник архива: записанное забирает генератор ответа"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+class ZipExportWriter:
+    """Zip в поток без перемотки: размеры и CRC записей пишутся после данных"""
+
+    def __init__(self, sink):
+        self.archive = zipfile.ZipFile(sink, 'w')
+        self._entry = None
+
+    def begin(self, name, size, compress):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        info.file_size = size
+        self._entry = self.archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT)
+
+    def write(self, data):
+        self._entry.write(data)
+
+    def end(self):
+        self._entry.close()
+        self._entry = None
+
+    def close(self):
+        self.archive.close()
+
+
+class TarExportWriter:
+    """Tar в поток; размер записи должен быть известен до ее данных"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._offset = 0
+        self._size = 0
+        self._remaining = 0
+
+    def _emit(self, data):
+        self.sink.write(data)
+        self._offset += len(data)
+
+    def begin(self, name, size, compress):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._emit(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        self._size = size
+        self._remaining = size
+
+    def write(self, data):
+        if len(data) > self._remaining:
+            raise ValueError('Entry is larger than its declared size')
+        self._remaining -= len(data)
+        self._emit(data)
+
+    def end(self):
+        if self._remaining:
+            raise ValueError('Entry is smaller than its declared size')
+        self._emit(b'\0' * (-self._size % tarfile.BLOCKSIZE))
+
+    def close(self):
+        self._emit(b'\0' * (2 * tarfile.BLOCKSIZE))
+        self._emit(b'\0' * (-self._offset % tarfile.RECORDSIZE))
+
+
+def iter_room_messages(storage, archive_folder, room_link, batch_size=MESSAGE_PART_SIZE):
+    """Все сообщения комнаты порциями по возрастанию id: архивные сегменты, затем база"""
+    last_id = 0
+    batch = []
+    for path in sorted(list_segments(archive_folder, room_link)):
+        with open_reader(path) as reader:
+            for line in reader:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                # Строка, повторно архивированная после сбоя, идет после уже выданных
+                if row['id'] <= last_id:
+                    continue
+                last_id = row['id']
+                batch.append({field: row.get(field) for field in MESSAGE_FIELDS})
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+    while True:
+        rows = storage.get_messages(room_link, last_id, batch_size - len(batch))
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        batch.extend({field: row.get(field) for field in MESSAGE_FIELDS} for row in rows)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def to_ndjson(rows):
+    return b''.join(json.dumps(row, ensure_ascii=False, default=str).encode('utf-8') + b'\n' for row in rows)
+
+
+def export_room(storage, archive_folder, room, fmt='zip', chunk_size=EXPORT_CHUNK_SIZE):
+    """Генератор байтов архива комнаты (zip или tar) с постоянным расходом памяти.
+
+    Состав: room.json, messages/NNNNNN.ndjson, files.ndjson и files/<имя>
+    с исходным (несжатым) содержимым загрузок.
+    """
+    sink = StreamSink()
+    writer = ZipExportWriter(sink) if fmt == 'zip' else TarExportWriter(sink)
+    room_link = room['link']
+
+    def add(name, data):
+        writer.begin(name, len(data), True)
+        writer.write(data)
+        writer.end()
+
+    add('room.json', json.dumps({
+        'version': EXPORT_VERSION,
+        'link': room_link,
+        'name': room['name'],
+        'created_at': str(room['created_at']),
+        'exported_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    }, ensure_ascii=False).encode('utf-8'))
+    yield from sink.drain()
+
+    for part, batch in enumerate(iter_room_messages(storage, archive_folder, room_link), 1):
+        add(f'messages/{part:06d}.ndjson', to_ndjson(batch))
+        yield from sink.drain()
+
+    files = [file for file in storage.get_files(room_link) if os.path.exists(file['file_path'])]
+    add('files.ndjson', to_ndjson(
+        dict({field: file.get(field) for field in FILE_FIELDS}, archive_name=f"files/{file['filename']}")
+        for file in files))
+    yield from sink.drain()
+
+    for file in files:
+        try:
+            source = open_stored(file['file_path'], file['encoding'])
+        except FileNotFoundError:
+            # Файл удален во время выгрузки: в архиве останется только его описание
+            logger.warning(f"Export: file {file['id']} disappeared from room {room_link}")
+            continue
+        with source:
+            size = file['file_size'] if file['encoding'] else os.fstat(source.fileno()).st_size
+            # Содержимое загрузок обычно уже сжато, повторно не сжимаем
+            writer.begin(f"files/{file['filename']}", size, False)
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                writer.write(chunk)
+                yield from sink.drain()
+            writer.end()
+
+    writer.close()
+    yield from sink.drain()
+
+
+def iter_archive(path):
+    """Пары (имя, файл) записей архива экспорта в порядке записи"""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as f:
+                        yield info.filename, f
+        return
+
+    with tarfile.open(path, 'r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member)
+
+
+def import_room(storage, path, store_file, room_link=None, defer_indexes=True, batch_size=IMPORT_BATCH_SIZE):
+    """Загружает архив экспорта в существующую комнату.
+
+    Сообщения вставляются через executemany транзакциями по batch_size строк;
+    при defer_indexes индексы messages удаляются на время загрузки и строятся
+    заново в конце, поэтому загрузку лучше выполнять при остановленном чате.
+    store_file(файл, исходное имя) сохраняет содержимое загрузки и возвращает
+    {filename, file_path, file_size, stored_size, encoding}.
+    """
+    stats = {'room_link': room_link, 'messages': 0, 'file_ids': []}
+    users = {}
+    files = {}
+    batch = []
+    room_found = False
+    indexes_dropped = False
+
+    def resolve_user(username):
+        username = username or 'deleted'
+        if username not in users:
+            user = storage.get_user_by_username(username)
+            users[username] = user['id'] if user else storage.create_user(username, UNUSABLE_PASSWORD, '')
+        return users[username]
+
+    def flush():
+        if batch:
+            storage.bulk_add_messages(stats['room_link'], batch)
+            stats['messages'] += len(batch)
+            batch.clear()
+
+    try:
+        for name, f in iter_archive(path):
+            if name == 'room.json':
+                meta = json.load(f)
+                if meta.get('version') != EXPORT_VERSION:
+                    raise ValueError(f"Unsupported export version: {meta.get('version')}")
+                stats['room_link'] = stats['room_link'] or meta['link']
+                if storage.get_room(stats['room_link']) is None:
+                    raise ValueError(f"Room not found: {stats['room_link']}")
+                room_found = True
+                if defer_indexes:
+                    storage.drop_message_indexes(stats['room_link'])
+                    indexes_dropped = True
+                continue
+
+            if not room_found:
+                raise ValueError('room.json must be the first entry of the archive')
+
+            if name.startswith('messages/'):
+                for line in f:
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    batch.append((resolve_user(row['username']), row['message'], row['timestamp']))
+                    if len(batch) >= batch_size:
+                        flush()
+                continue
+
+            flush()
+            if name == 'files.ndjson':
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        files[row['archive_name']] = row
+            elif name in files:
+                row = files[name]
+                stored = store_file(f, row['original_filename'])
+                stats['file_ids'].append(storage.add_file(
+                    stats['room_link'], resolve_user(row['username']), stored['filename'],
+                    row['original_filename'], stored['file_path'], stored['file_size'], row['file_type'],
+                    stored['stored_size'], stored['encoding']))
+        flush()
+    finally:
+        if indexes_dropped:
+            storage.restore_message_indexes(stats['room_link'])
+    return stats
@@ -0,0 +1,56 @@
+import logging
+import os
+import secrets
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def load_config(app, defaults, prefix, config=None):
+    """Загружает настройки по возрастанию приоритета.
+
+    defaults, файл из переменной окружения {prefix}_SETTINGS, переменные
+    {prefix}_* (значения разбираются как JSON) и, наконец, словарь config.
+    """
+    app.config.from_object(defaults)
+    app.config.from_envvar(f'{prefix}_SETTINGS', silent=True)
+    app.config.from_prefixed_env(prefix)
+    if config:
+        app.config.update(config)
+
+
+def load_secret_key(app):
+    """Берет SECRET_KEY из настроек, иначе из SECRET_KEY_FILE, создавая его при первом запуске.
+
+    os.urandom при каждом старте дает каждому процессу свой ключ: сессия,
+    подписанная одним воркером, не читается другим и теряется при перезапуске.
+    """
+    if app.config.get('SECRET_KEY'):
+        return
+    path = app.config['SECRET_KEY_FILE']
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # Ключ пишется во временный файл и появляется атомарно: одновременно
+        # стартующие процессы прочитают один и тот же ключ
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as f:
+        app.config['SECRET_KEY'] = f.read().strip()
+
+
+def setup_logging(log_file=None):
+    """Настраивает логи в консоль и в log_file; повторный вызов ничего не меняет"""
+    if logging.getLogger().handlers:
+        return
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        handlers.insert(0, logging.FileHandler(log_file))
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, handlers=handlers)
@@ -2,7 +2,38 @@ document.addEventListener('DOMContentLoaded', function() {
     const messageInput = document.getElementById('message-input');
     const sendButton = document.getElementById('send-button');
     const messagesContainer = document.getElementById('messages-container');
+    const loadOlderButton = document.getElementById('load-older-button');
     let isSending = false;
+    let isLoadingOlder = false;
+    
+    const CACHE_LIMIT = 1000;
+    const PAGE_SIZE = 100;
+    const OVERSCAN = 10;
+    const LATEST_ID = Number.MAX_SAFE_INTEGER;
+    
+    // Виртуальный список: все сообщения хранятся в массиве, а в DOM
+    // находятся только строки видимого окна между двумя распорками
+    const messages = [];
+    const messageIds = new Set();
+    const freshIds = new Set();
+    const heights = new Map();
+    let estimatedHeight = 60;
+    let offsets = [0];
+    let offsetsDirty = false;
+    let renderedStart = 0;
+    let renderedEnd = 0;
+    let renderedRows = new Map();
+    let stickToBottom = true;
+    let renderScheduled = false;
+    let lastMessageId = 0;
+    
+    const virtualList = document.createElement('div');
+    virtualList.className = 'virtual-list';
+    const topSpacer = document.createElement('div');
+    const rowsHost = document.createElement('div');
+    const bottomSpacer = document.createElement('div');
+    virtualList.append(topSpacer, rowsHost, bottomSpacer);
+    messagesContainer.appendChild(virtualList);
 
     function sendMessage() {
         if (isSending) return;
@@ -26,6 +57,7 @@ document.addEventListener('DOMContentLoaded', function() {
             .then(data => {
                 if (data.success) {
                     messageInput.value = '';
+                    ChatSync.syncNow();
                 } else {
                     console.error('Ошибка отправки:', data.error);
                     alert('Ошибка отправки сообщения: ' + data.error);
@@ -42,27 +74,161 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    function getNewMessages() {
-        fetch(`/get_messages/${roomLink}?last_id=${lastMessageId}`)
-            .then(response => response.json())
-            .then(data => {
-                if (data.success && data.messages && data.messages.length > 0) {
-                    data.messages.forEach(msg => {
-                        addMessageToChat(msg);
-                        lastMessageId = Math.max(lastMessageId, msg.id);
-                    });
-                    scrollToBottom();
-                }
-            })
-            .catch(error => {
-                console.error('Ошибка получения сообщений:', error);
-            });
+    function showNewMessages(newMessages) {
+        const added = appendMessages(newMessages, true);
+        HistoryCache.save(currentUserId, roomLink, added, CACHE_LIMIT);
+        if (stickToBottom) {
+            scrollToBottom();
+        } else {
+            scheduleRender();
+        }
     }
 
-    function addMessageToChat(message) {
-        const existingMessage = document.querySelector(`.message[data-id="${message.id}"]`);
-        if (existingMessage) return;
+    // Добавляет сообщения новее уже показанных; возвращает добавленные
+    function appendMessages(newMessages, animate) {
+        const added = [];
+        newMessages.forEach(msg => {
+            if (messageIds.has(msg.id) || msg.id <= lastMessageId) return;
+            messageIds.add(msg.id);
+            messages.push(msg);
+            added.push(msg);
+            if (animate) freshIds.add(msg.id);
+            lastMessageId = msg.id;
+        });
+        if (added.length > 0) offsetsDirty = true;
+        return added;
+    }
+
+    function prependMessages(olderMessages) {
+        const added = olderMessages.filter(msg => !messageIds.has(msg.id) && (messages.length === 0 || msg.id < messages[0].id));
+        if (added.length === 0) return;
+        added.forEach(msg => messageIds.add(msg.id));
+        messages.unshift(...added);
         
+        // Сдвигаем прокрутку на высоту вставленных строк, чтобы лента не прыгала
+        const addedHeight = added.reduce((sum, msg) => sum + heightOf(msg), 0);
+        const previousTop = messagesContainer.scrollTop;
+        offsetsDirty = true;
+        renderedStart = renderedEnd = 0;
+        render();
+        messagesContainer.scrollTop = previousTop + addedHeight;
+        render();
+    }
+
+    function resetMessages() {
+        messages.length = 0;
+        messageIds.clear();
+        freshIds.clear();
+        heights.clear();
+        lastMessageId = 0;
+        offsetsDirty = true;
+        renderedStart = renderedEnd = 0;
+    }
+
+    function heightOf(msg) {
+        return heights.get(msg.id) || estimatedHeight;
+    }
+
+    function rebuildOffsets() {
+        offsets = new Array(messages.length + 1);
+        offsets[0] = 0;
+        for (let i = 0; i < messages.length; i++) {
+            offsets[i + 1] = offsets[i] + heightOf(messages[i]);
+        }
+        offsetsDirty = false;
+    }
+
+    // Индекс сообщения, на которое приходится координата y списка
+    function indexAt(y) {
+        let lo = 0;
+        let hi = messages.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (offsets[mid + 1] <= y) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        return lo;
+    }
+
+    function scheduleRender() {
+        if (renderScheduled) return;
+        renderScheduled = true;
+        requestAnimationFrame(() => {
+            renderScheduled = false;
+            render();
+        });
+    }
+
+    function render() {
+        if (offsetsDirty) rebuildOffsets();
+        
+        const listTop = virtualList.offsetTop - messagesContainer.offsetTop;
+        const top = messagesContainer.scrollTop - listTop;
+        const bottom = top + messagesContainer.clientHeight;
+        const start = Math.max(0, indexAt(top) - OVERSCAN);
+        const end = Math.min(messages.length, indexAt(bottom) + 1 + OVERSCAN);
+        
+        topSpacer.style.height = offsets[start] + 'px';
+        bottomSpacer.style.height = (offsets[messages.length] - offsets[end]) + 'px';
+        if (start === renderedStart && end === renderedEnd && rowsHost.childElementCount === end - start) return;
+        
+        // Строки, оставшиеся в окне, переиспользуются
+        const rows = new Map();
+        const fragment = document.createDocumentFragment();
+        for (let i = start; i < end; i++) {
+            const msg = messages[i];
+            const row = renderedRows.get(msg.id) || createRow(msg);
+            rows.set(msg.id, row);
+            fragment.appendChild(row);
+        }
+        rowsHost.replaceChildren(fragment);
+        renderedRows = rows;
+        renderedStart = start;
+        renderedEnd = end;
+        
+        measure();
+    }
+
+    function measure() {
+        let changed = false;
+        let total = 0;
+        renderedRows.forEach((row, id) => {
+            const height = row.offsetHeight;
+            total += height;
+            if (height && heights.get(id) !== height) {
+                heights.set(id, height);
+                changed = true;
+            }
+        });
+        if (renderedRows.size > 0 && total > 0) {
+            estimatedHeight = total / renderedRows.size;
+        }
+        if (changed) {
+            offsetsDirty = true;
+            rebuildOffsets();
+            topSpacer.style.height = offsets[renderedStart] + 'px';
+            bottomSpacer.style.height = (offsets[messages.length] - offsets[renderedEnd]) + 'px';
+            if (stickToBottom) {
+                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            }
+        }
+    }
+
+    function createRow(message) {
+        const row = document.createElement('div');
+        row.className = 'message-row';
+        const element = createMessageElement(message);
+        if (freshIds.delete(message.id)) {
+            element.classList.add('message-appear');
+        }
+        row.appendChild(element);
+        return row;
+    }
+
+    function createMessageElement(message) {
         const messageDiv = document.createElement('div');
         messageDiv.className = 'message';
         messageDiv.setAttribute('data-id', message.id);
@@ -83,21 +249,116 @@ document.addEventListener('DOMContentLoaded', function() {
         messageDiv.appendChild(textSpan);
         messageDiv.appendChild(timeSpan);
         
-        messagesContainer.appendChild(messageDiv);
+        return messageDiv;
     }
 
     function scrollToBottom() {
+        render();
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        render();
+    }
+
+    function fetchHistory(beforeId) {
+        return fetch(`/get_history/${roomLink}?before_id=${beforeId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.error);
+                }
+                return data;
+            });
+    }
+
+    function setHasOlder(hasOlder) {
+        loadOlderButton.style.display = hasOlder ? '' : 'none';
+    }
+
+    function loadOlderMessages() {
+        if (isLoadingOlder || messages.length === 0) return;
+        
+        isLoadingOlder = true;
+        loadOlderButton.disabled = true;
+        
+        fetchHistory(messages[0].id)
+            .then(data => {
+                prependMessages(data.messages);
+                setHasOlder(data.has_more);
+            })
+            .catch(error => {
+                console.error('Ошибка загрузки истории:', error);
+            })
+            .finally(() => {
+                isLoadingOlder = false;
+                loadOlderButton.disabled = false;
+            });
     }
 
+    function loadLatestPage() {
+        return fetchHistory(LATEST_ID).then(data => {
+            appendMessages(data.messages, false);
+            setHasOlder(data.has_more);
+            return HistoryCache.save(currentUserId, roomLink, data.messages, CACHE_LIMIT);
+        });
+    }
+
+    // Дочитывает сообщения новее кеша; если их больше страницы, кеш
+    // слишком устарел, и история загружается заново с последней страницы
+    function catchUp() {
+        return fetch(`/get_messages/${roomLink}?last_id=${lastMessageId}&limit=${PAGE_SIZE}`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    throw new Error(data.error);
+                }
+                if (data.messages.length < PAGE_SIZE) {
+                    HistoryCache.save(currentUserId, roomLink, appendMessages(data.messages, false), CACHE_LIMIT);
+                    return;
+                }
+                resetMessages();
+                return HistoryCache.clear(currentUserId, roomLink).then(loadLatestPage);
+            });
+    }
+
+    function loadInitialMessages() {
+        return HistoryCache.load(currentUserId, roomLink, CACHE_LIMIT).then(cached => {
+            if (cached.length === 0) {
+                return loadLatestPage();
+            }
+            appendMessages(cached, false);
+            setHasOlder(true);
+            scrollToBottom();
+            return catchUp();
+        });
+    }
+    
+    messagesContainer.addEventListener('scroll', function() {
+        stickToBottom = messagesContainer.scrollTop + messagesContainer.clientHeight >= messagesContainer.scrollHeight - 5;
+        scheduleRender();
+    });
+    window.addEventListener('resize', scheduleRender);
+    
     sendButton.addEventListener('click', sendMessage);
+    loadOlderButton.addEventListener('click', loadOlderMessages);
     
     messageInput.addEventListener('keypress', function(e) {
         if (e.key === 'Enter') {
             sendMessage();
         }
     });
-
-    setInterval(getNewMessages, 1000);
-    scrollToBottom();
-});
\ No newline at end of file
+    
+    // Опрос начинается только после загрузки истории: с нулевым курсором
+    // /sync вернул бы всю комнату
+    function start() {
+        loadInitialMessages()
+            .then(() => {
+                scrollToBottom();
+                ChatSync.watch(roomLink, {last_message_id: lastMessageId}, {messages: showNewMessages});
+            })
+            .catch(error => {
+                console.error('Ошибка загрузки сообщений:', error);
+                setTimeout(start, 3000);
+            });
+    }
+    
+    start();
+});
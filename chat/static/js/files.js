@@ -1,7 +1,8 @@
 document.addEventListener('DOMContentLoaded', function() {
     initTabs();
     initFileUpload();
-    loadFiles();
+    ChatSync.watch(roomLink, {last_file_id: lastFileId, file_count: fileCount, processed_count: processedCount},
+                   {files: displayFiles});
 });
 
 function initTabs() {
@@ -66,7 +67,8 @@ function uploadFile(file) {
     
     const fileItem = createUploadingFileItem(file.name, file.size);
     
-    fetch('/upload_file', {
+    // room_link в адресе нужен серверу для лимитов до чтения тела запроса
+    fetch('/upload_file?room_link=' + encodeURIComponent(roomLink), {
         method: 'POST',
         body: formData
     })
@@ -74,7 +76,7 @@ function uploadFile(file) {
     .then(data => {
         if (data.success) {
             fileItem.remove();
-            loadFiles();
+            ChatSync.syncNow();
             showNotification('Файл успешно загружен', 'success');
         } else {
             fileItem.querySelector('.file-status').textContent = 'Ошибка: ' + data.error;
@@ -111,21 +113,6 @@ function createUploadingFileItem(filename, size) {
     return fileItem;
 }
 
-function loadFiles() {
-    fetch(`/get_files/${roomLink}`)
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                displayFiles(data.files);
-            } else {
-                console.error('Ошибка загрузки файлов:', data.error);
-            }
-        })
-        .catch(error => {
-            console.error('Ошибка:', error);
-        });
-}
-
 function displayFiles(files) {
     const filesList = document.getElementById('files-list');
     filesList.innerHTML = '';
@@ -142,8 +129,15 @@ function displayFiles(files) {
         
         const canDelete = currentUserId === file.user_id || roomCreatorId === currentUserId;
         
+        // Миниатюра появляется после фоновой обработки загрузки
+        const preview = file.thumbnails.includes(128)
+            ? `<a href="/thumbnail/${file.id}?size=512&room_link=${roomLink}" target="_blank" class="file-thumbnail">
+                   <img src="/thumbnail/${file.id}?size=128&room_link=${roomLink}" alt="" loading="lazy">
+               </a>`
+            : `<div class="file-icon">${file.icon}</div>`;
+        
         fileItem.innerHTML = `
-            <div class="file-icon">${file.icon}</div>
+            ${preview}
             <div class="file-info">
                 <div class="file-name" title="${file.original_filename}">${file.original_filename}</div>
                 <div class="file-details">
@@ -163,7 +157,7 @@ function displayFiles(files) {
 }
 
 function downloadFile(fileId) {
-    window.open(`/download_file/${fileId}`, '_blank');
+    window.open(`/download_file/${fileId}?room_link=${roomLink}`, '_blank');
 }
 
 function deleteFile(fileId) {
@@ -171,7 +165,7 @@ function deleteFile(fileId) {
         return;
     }
     
-    fetch(`/delete_file/${fileId}`, {
+    fetch(`/delete_file/${fileId}?room_link=${roomLink}`, {
         method: 'DELETE'
     })
     .then(response => response.json())
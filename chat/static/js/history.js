@@ -0,0 +1,130 @@
+// Кеш истории комнат в IndexedDB: хранит до CACHE_LIMIT последних сообщений
+// комнаты, чтобы при открытии запрашивать у сервера только более новые.
+// Записи разделены по пользователям; при выходе из комнаты и из аккаунта
+// кеш очищается.
+const HistoryCache = (function() {
+    const DB_NAME = 'chat-history';
+    const DB_VERSION = 2;
+    const STORE = 'messages';
+    let dbPromise = null;
+
+    function open() {
+        if (!dbPromise) {
+            dbPromise = new Promise((resolve, reject) => {
+                if (!('indexedDB' in window)) {
+                    reject(new Error('IndexedDB недоступен'));
+                    return;
+                }
+                const request = indexedDB.open(DB_NAME, DB_VERSION);
+                request.onupgradeneeded = () => {
+                    // Версия 1 хранила историю без пользователя
+                    const db = request.result;
+                    if (db.objectStoreNames.contains(STORE)) {
+                        db.deleteObjectStore(STORE);
+                    }
+                    db.createObjectStore(STORE, {keyPath: ['user_id', 'room_link', 'id']});
+                };
+                request.onsuccess = () => {
+                    const db = request.result;
+                    // Не мешаем удалению базы из другой вкладки
+                    db.onversionchange = () => {
+                        db.close();
+                        dbPromise = null;
+                    };
+                    resolve(db);
+                };
+                request.onerror = () => reject(request.error);
+            });
+        }
+        return dbPromise;
+    }
+
+    function roomRange(userId, roomLink, upperId = Infinity, upperOpen = false) {
+        return IDBKeyRange.bound([userId, roomLink, -Infinity], [userId, roomLink, upperId], false, upperOpen);
+    }
+
+    function transaction(mode, callback) {
+        return open().then(db => new Promise((resolve, reject) => {
+            const tx = db.transaction(STORE, mode);
+            const result = callback(tx.objectStore(STORE));
+            tx.oncomplete = () => resolve(result);
+            tx.onerror = () => reject(tx.error);
+        }));
+    }
+
+    // Последние limit сообщений комнаты по возрастанию id
+    function load(userId, roomLink, limit) {
+        return transaction('readonly', store => {
+            const messages = [];
+            store.openCursor(roomRange(userId, roomLink), 'prev').onsuccess = event => {
+                const cursor = event.target.result;
+                if (cursor && messages.length < limit) {
+                    messages.push(cursor.value);
+                    cursor.continue();
+                }
+            };
+            return messages;
+        }).then(messages => messages.reverse())
+          .catch(error => {
+              console.error('Ошибка чтения кеша истории:', error);
+              return [];
+          });
+    }
+
+    // Сохраняет новые сообщения и удаляет вышедшие за CACHE_LIMIT
+    function save(userId, roomLink, messages, limit) {
+        if (messages.length === 0) return Promise.resolve();
+        return transaction('readwrite', store => {
+            messages.forEach(msg => store.put(Object.assign({user_id: userId, room_link: roomLink}, msg)));
+            let kept = 0;
+            store.openKeyCursor(roomRange(userId, roomLink), 'prev').onsuccess = event => {
+                const cursor = event.target.result;
+                if (!cursor) return;
+                if (++kept > limit) {
+                    store.delete(roomRange(userId, roomLink, cursor.primaryKey[2]));
+                    return;
+                }
+                cursor.continue();
+            };
+        }).catch(error => {
+            console.error('Ошибка записи кеша истории:', error);
+        });
+    }
+
+    function clear(userId, roomLink) {
+        return transaction('readwrite', store => {
+            store.delete(roomRange(userId, roomLink));
+        }).catch(error => {
+            console.error('Ошибка очистки кеша истории:', error);
+        });
+    }
+
+    // Удаляет кеш целиком, включая историю других пользователей этого браузера
+    function clearAll() {
+        return new Promise(resolve => {
+            if (!('indexedDB' in window)) {
+                resolve();
+                return;
+            }
+            const close = dbPromise ? dbPromise.then(db => db.close(), () => {}) : Promise.resolve();
+            dbPromise = null;
+            close.then(() => {
+                const request = indexedDB.deleteDatabase(DB_NAME);
+                request.onsuccess = () => resolve();
+                request.onerror = () => {
+                    console.error('Ошибка удаления кеша истории:', request.error);
+                    resolve();
+                };
+                // Другая вкладка еще держит базу: удаление завершится, когда она ее закроет
+                request.onblocked = () => resolve();
+            });
+        });
+    }
+
+    return {
+        load: load,
+        save: save,
+        clear: clear,
+        clearAll: clearAll
+    };
+})();
@@ -0,0 +1,212 @@
+// Общий планировщик опроса /sync для chat.js и files.js.
+//
+// Вкладки одного браузера опрашивают сервер через одну ведущую вкладку:
+// ведущая выбирается блокировкой Web Locks, курсоры и ответы передаются
+// через BroadcastChannel. Без этих API каждая вкладка опрашивает сервер сама.
+const ChatSync = (function() {
+    const INTERVAL = 1000;
+    const MAX_ROOMS = 50;         // как SYNC_MAX_ROOMS на сервере
+    const PEER_TIMEOUT = 5000;    // курсоры молчащей вкладки забываются
+    const LEADER_TIMEOUT = 3000;  // без ответов ведущей вкладка опрашивает сама
+    const tabId = Math.random().toString(36).slice(2);
+    const channel = ('BroadcastChannel' in window && navigator.locks) ? new BroadcastChannel('chat-sync') : null;
+
+    const rooms = {};  // комнаты этой вкладки: room_link -> {cursor, handlers}
+    const peers = {};  // курсоры других вкладок: tabId -> {rooms, seen}
+    let isLeader = !channel;
+    let lastLeaderResultAt = Date.now();
+    let inFlight = false;
+    let hasMore = false;  // сервер отдал не все новые сообщения - следующая страница сразу
+
+    function watch(roomLink, cursor, handlers) {
+        if (!rooms[roomLink]) {
+            rooms[roomLink] = {cursor: {}, handlers: []};
+        }
+        Object.assign(rooms[roomLink].cursor, cursor);
+        rooms[roomLink].handlers.push(handlers);
+    }
+
+    function ownCursors() {
+        const cursors = {};
+        for (const link in rooms) {
+            cursors[link] = Object.assign({}, rooms[link].cursor);
+        }
+        return cursors;
+    }
+
+    function mergeCursor(target, cursor) {
+        if ('last_message_id' in cursor) {
+            target.last_message_id = 'last_message_id' in target
+                ? Math.min(target.last_message_id, cursor.last_message_id)
+                : cursor.last_message_id;
+        }
+        if ('last_file_id' in cursor) {
+            if (!('last_file_id' in target)) {
+                target.last_file_id = cursor.last_file_id;
+                target.file_count = cursor.file_count;
+                target.processed_count = cursor.processed_count;
+            } else if (target.last_file_id !== cursor.last_file_id || target.file_count !== cursor.file_count ||
+                       target.processed_count !== cursor.processed_count) {
+                // Вкладки видят разные списки файлов - запрашиваем список целиком
+                target.last_file_id = -1;
+                target.file_count = -1;
+                target.processed_count = -1;
+            }
+        }
+    }
+
+    function collectCursors() {
+        const merged = {};
+        const now = Date.now();
+        const sources = [ownCursors()];
+        for (const id in peers) {
+            if (now - peers[id].seen > PEER_TIMEOUT) {
+                delete peers[id];
+            } else {
+                sources.push(peers[id].rooms);
+            }
+        }
+        sources.forEach(source => {
+            for (const link in source) {
+                mergeCursor(merged[link] || (merged[link] = {}), source[link]);
+            }
+        });
+        return merged;
+    }
+
+    function apply(results) {
+        for (const link in results) {
+            const room = rooms[link];
+            if (!room) continue;
+            const delta = results[link];
+
+            if (delta.messages && 'last_message_id' in room.cursor) {
+                // Ответ мог быть получен по курсору другой вкладки
+                const fresh = delta.messages.filter(msg => msg.id > room.cursor.last_message_id);
+                if (fresh.length > 0) {
+                    room.cursor.last_message_id = fresh[fresh.length - 1].id;
+                    room.handlers.forEach(handlers => handlers.messages && handlers.messages(fresh));
+                }
+            }
+
+            if (delta.files && 'last_file_id' in room.cursor) {
+                room.cursor.last_file_id = delta.files.reduce((max, file) => Math.max(max, file.id), 0);
+                room.cursor.file_count = delta.files.length;
+                room.cursor.processed_count = delta.files.filter(file => file.processed).length;
+                room.handlers.forEach(handlers => handlers.files && handlers.files(delta.files));
+            }
+        }
+    }
+
+    function advancePeers(results) {
+        // Вкладки применят тот же ответ; без этого следующая страница
+        // запрашивалась бы по их прежним курсорам
+        for (const id in peers) {
+            for (const link in results) {
+                const cursor = peers[id].rooms[link];
+                const messages = results[link].messages;
+                if (cursor && 'last_message_id' in cursor && messages && messages.length > 0) {
+                    cursor.last_message_id = Math.max(cursor.last_message_id, messages[messages.length - 1].id);
+                }
+            }
+        }
+    }
+
+    function poll(cursors) {
+        const links = Object.keys(cursors);
+        if (links.length === 0) return;
+
+        inFlight = true;
+        const requests = [];
+        for (let i = 0; i < links.length; i += MAX_ROOMS) {
+            const chunk = {};
+            links.slice(i, i + MAX_ROOMS).forEach(link => chunk[link] = cursors[link]);
+
+            requests.push(fetch('/sync', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({rooms: chunk})
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) {
+                    console.error('Ошибка синхронизации:', data.error);
+                    return;
+                }
+                apply(data.rooms);
+                if (channel) {
+                    channel.postMessage({type: 'result', rooms: data.rooms});
+                    advancePeers(data.rooms);
+                }
+                if (Object.values(data.rooms).some(delta => delta.has_more)) {
+                    hasMore = true;
+                }
+            }));
+        }
+
+        Promise.all(requests)
+            .catch(error => {
+                console.error('Ошибка синхронизации:', error);
+            })
+            .finally(() => {
+                inFlight = false;
+                if (hasMore) {
+                    hasMore = false;
+                    syncNow();
+                }
+            });
+    }
+
+    function tick() {
+        if (channel && Object.keys(rooms).length > 0) {
+            channel.postMessage({type: 'cursors', tab: tabId, rooms: ownCursors()});
+        }
+        if (inFlight) return;
+
+        if (isLeader) {
+            poll(collectCursors());
+        } else if (Date.now() - lastLeaderResultAt > LEADER_TIMEOUT && !document.hidden) {
+            // Таймеры фоновой ведущей вкладки замедляются браузером
+            poll(ownCursors());
+        }
+    }
+
+    function syncNow() {
+        if (!inFlight) {
+            poll(isLeader ? collectCursors() : ownCursors());
+        }
+    }
+
+    if (channel) {
+        channel.onmessage = function(event) {
+            const data = event.data;
+            if (data.type === 'cursors') {
+                peers[data.tab] = {rooms: data.rooms, seen: Date.now()};
+            } else if (data.type === 'result') {
+                lastLeaderResultAt = Date.now();
+                apply(data.rooms);
+            } else if (data.type === 'bye') {
+                delete peers[data.tab];
+            }
+        };
+
+        // Блокировка удерживается, пока вкладка открыта; затем ее получает следующая
+        navigator.locks.request('chat-sync-leader', () => {
+            isLeader = true;
+            return new Promise(() => {});
+        });
+
+        window.addEventListener('pagehide', () => {
+            channel.postMessage({type: 'bye', tab: tabId});
+        });
+    }
+
+    setInterval(tick, INTERVAL);
+
+    return {
+        watch: watch,
+        syncNow: syncNow
+    };
+})();
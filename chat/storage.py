@@ -0,0 +1,1212 @@
+import json
+import logging
+import os
+import select
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+logger = logging.getLogger(__name__)
+
+VACUUM_STEP_PAGES = 256
+DELETE_CHUNK_SIZE = 500
+
+# Индексы messages, удаляемые на время массовой загрузки
+MESSAGE_INDEXES = ('idx_messages_room_link', 'idx_messages_timestamp')
+
+# Первый ключ advisory-блокировки вставок сообщений в Postgres, второй - hashtext(room_link)
+MESSAGES_LOCK_CLASS = 1
+
+# Размер на диске и кодировка сжатой загрузки (NULL - файл хранится как есть)
+FILE_STORAGE_COLUMNS = [
+    ('stored_size', 'BIGINT'),
+    ('encoding', 'TEXT'),
+]
+
+# Метаданные, которые фоновая обработка дописывает к файлу после загрузки
+FILE_METADATA_COLUMNS = [
+    ('sha256', 'TEXT'),
+    ('mime_type', 'TEXT'),
+    ('thumbnails', 'TEXT'),  # размеры миниатюр через запятую
+    ('processed_at', 'TIMESTAMP'),
+]
+
+# Счетчики занятого загрузками места ведутся в той же базе, что и files
+# (в шардах тоже), и меняются в одной транзакции с записью файла. Пересчет
+# по таблице files - для первого запуска и сверки с диском.
+EMPTY_USAGE = {'files': 0, 'file_size': 0, 'stored_size': 0}
+USAGE_REBUILD = (
+    'DELETE FROM room_usage',
+    '''
+    INSERT INTO room_usage (room_link, files, file_size, stored_size)
+    SELECT room_link, COUNT(*), SUM(file_size), SUM(COALESCE(stored_size, file_size))
+    FROM files GROUP BY room_link
+    ''',
+    'DELETE FROM user_usage',
+    '''
+    INSERT INTO user_usage (user_id, files, file_size, stored_size)
+    SELECT user_id, COUNT(*), SUM(file_size), SUM(COALESCE(stored_size, file_size))
+    FROM files GROUP BY user_id
+    ''',
+)
+
+
+# Участники комнат, существовавших до появления room_members: создатели комнат;
+# выполняется в основной базе. Имеющаяся история считается прочитанной.
+ROOM_MEMBERS_BACKFILL = '''
+    INSERT INTO room_members (user_id, room_link)
+    SELECT created_by, link FROM rooms
+    WHERE true
+    ON CONFLICT (user_id, room_link) DO NOTHING
+'''
+# Выполняются в каждой базе с комнатами (в шардах тоже): авторы сообщений -
+# тоже участники, активность комнаты - ее последнее сообщение
+ROOM_ACTIVITY_BACKFILL = (
+    '''
+    INSERT INTO room_members (user_id, room_link)
+    SELECT DISTINCT user_id, room_link FROM messages
+    WHERE true
+    ON CONFLICT (user_id, room_link) DO NOTHING
+    ''',
+    '''
+    INSERT INTO room_activity (room_link, last_message_id, last_activity)
+    SELECT room_link, MAX(id), COALESCE(MAX(timestamp), CURRENT_TIMESTAMP) FROM messages
+    WHERE true
+    GROUP BY room_link
+    ON CONFLICT (room_link) DO NOTHING
+    ''',
+)
+READ_POSITIONS_BACKFILL = '''
+    INSERT INTO read_positions (room_link, user_id, last_read_id)
+    SELECT room_members.room_link, room_members.user_id, room_activity.last_message_id
+    FROM room_members
+    JOIN room_activity ON room_activity.room_link = room_members.room_link
+    WHERE true
+    ON CONFLICT (room_link, user_id) DO NOTHING
+'''
+
+
+class IntegrityError(Exception):
+    """Нарушение ограничений базы (например, занятое имя пользователя)"""
+
+
+class BaseStorage:
+    """Общие запросы к users, rooms, messages и files.
+
+    Бэкенды реализуют получение соединения, подготовку запроса и
+    преобразование строк; сами запросы написаны на общем подмножестве SQL.
+    """
+
+    integrity_errors = ()
+    sharded = False
+
+    def __init__(self):
+        self._listeners = []
+
+    # Соединения
+
+    def _acquire(self, room_link=None):
+        raise NotImplementedError
+
+    def _release(self, conn):
+        raise NotImplementedError
+
+    def _cursor(self, conn):
+        return conn.cursor()
+
+    def _prepare(self, query):
+        return query
+
+    def _row(self, row):
+        return dict(row)
+
+    @contextmanager
+    def _transaction(self, room_link=None):
+        conn = self._acquire(room_link)
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def _execute(self, conn, query, params=()):
+        cursor = self._cursor(conn)
+        try:
+            cursor.execute(self._prepare(query), params)
+        except self.integrity_errors as e:
+            raise IntegrityError(str(e)) from e
+        except Exception as e:
+            logger.error(f"SQL error: {e}")
+            raise
+        return cursor
+
+    def _executemany(self, conn, query, rows):
+        cursor = self._cursor(conn)
+        try:
+            cursor.executemany(self._prepare(query), rows)
+        except self.integrity_errors as e:
+            raise IntegrityError(str(e)) from e
+        except Exception as e:
+            logger.error(f"SQL error: {e}")
+            raise
+        return cursor
+
+    def _fetchone(self, query, params=(), room_link=None):
+        with self._transaction(room_link) as conn:
+            row = self._execute(conn, query, params).fetchone()
+            return self._row(row) if row else None
+
+    def _fetchall(self, query, params=(), room_link=None):
+        with self._transaction(room_link) as conn:
+            return [self._row(row) for row in self._execute(conn, query, params).fetchall()]
+
+    # Уведомления о новых сообщениях и файлах
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def _dispatch(self, event):
+        for callback in list(self._listeners):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Storage listener error: {e}")
+
+    def _notify(self, conn, event):
+        """Вызывается внутри транзакции записи"""
+
+    def _committed(self, event):
+        """Вызывается после фиксации транзакции записи"""
+
+    # Пользователи
+
+    def create_user(self, username, password, salt):
+        with self._transaction() as conn:
+            row = self._execute(conn, 'INSERT INTO users (username, password, salt) VALUES (?, ?, ?) RETURNING id',
+                                (username, password, salt)).fetchone()
+            return self._row(row)['id']
+
+    def get_user_by_username(self, username):
+        return self._fetchone('SELECT * FROM users WHERE username = ?', (username,))
+
+    # Комнаты
+
+    def get_room(self, room_link):
+        return self._fetchone('SELECT * FROM rooms WHERE link = ?', (room_link,))
+
+    def list_rooms(self):
+        return self._fetchall('SELECT * FROM rooms')
+
+    def create_room(self, room_link, name, password, salt, created_by):
+        with self._transaction() as conn:
+            self._execute(conn, 'INSERT INTO rooms (link, name, password, salt, created_by) VALUES (?, ?, ?, ?, ?)',
+                          (room_link, name, password, salt, created_by))
+        with self._transaction(room_link) as conn:
+            self._execute(conn, 'INSERT INTO room_activity (room_link) VALUES (?) ON CONFLICT (room_link) DO NOTHING',
+                          (room_link,))
+
+    # Участники комнат и курсоры прочтения. Участники хранятся в основной базе,
+    # а активность комнаты и курсоры - рядом с ее сообщениями (в шарде):
+    # отправка и чтение сообщений не пишут в основную базу, а непрочитанные
+    # считаются только для комнат, показанных на странице.
+
+    def add_room_member(self, room_link, user_id):
+        with self._transaction() as conn:
+            self._execute(conn, '''
+                INSERT INTO room_members (user_id, room_link) VALUES (?, ?)
+                ON CONFLICT (user_id, room_link) DO NOTHING
+            ''', (user_id, room_link))
+        # Прежняя история для нового участника считается прочитанной
+        with self._transaction(room_link) as conn:
+            self._execute(conn, '''
+                INSERT INTO read_positions (room_link, user_id, last_read_id)
+                SELECT room_link, ?, last_message_id FROM room_activity WHERE room_link = ?
+                ON CONFLICT (room_link, user_id) DO NOTHING
+            ''', (user_id, room_link))
+
+    def remove_room_member(self, room_link, user_id):
+        with self._transaction() as conn:
+            self._execute(conn, 'DELETE FROM room_members WHERE user_id = ? AND room_link = ?', (user_id, room_link))
+        with self._transaction(room_link) as conn:
+            self._execute(conn, 'DELETE FROM read_positions WHERE room_link = ? AND user_id = ?', (room_link, user_id))
+
+    def _member_rooms_query(self, user_id, limit, before):
+        query = '''
+            SELECT rooms.link, rooms.name, room_activity.last_activity, room_activity.last_message_id,
+                   COALESCE(read_positions.last_read_id, room_activity.last_message_id) AS last_read_id
+            FROM room_members
+            JOIN room_activity ON room_activity.room_link = room_members.room_link
+            JOIN rooms ON rooms.link = room_members.room_link
+            LEFT JOIN read_positions ON read_positions.room_link = room_members.room_link
+                                    AND read_positions.user_id = room_members.user_id
+            WHERE room_members.user_id = ?
+        '''
+        params = (user_id,)
+        if before is not None:
+            query += '''
+              AND (room_activity.last_activity < ?
+                   OR (room_activity.last_activity = ? AND room_activity.room_link < ?))
+            '''
+            params += (before[0], before[0], before[1])
+        query += ' ORDER BY room_activity.last_activity DESC, room_activity.room_link DESC LIMIT ?'
+        return query, params + (limit,)
+
+    def list_member_rooms(self, user_id, limit, before=None):
+        """Комнаты пользователя от последней активности к ранней.
+
+        before: (last_activity, room_link) последней комнаты предыдущей страницы.
+        last_read_id и last_message_id передаются в count_unread.
+        """
+        return self._fetchall(*self._member_rooms_query(user_id, limit, before))
+
+    def count_unread(self, read_ids, limit):
+        """Непрочитанные сообщения, не больше limit на комнату: read_ids {room_link: last_read_id}"""
+        counts = {}
+        for group in self._group_rooms(read_ids):
+            with self._transaction(group[0]) as conn:
+                for room_link in group:
+                    row = self._execute(conn, '''
+                        SELECT COUNT(*) AS unread FROM (
+                            SELECT 1 FROM messages WHERE room_link = ? AND id > ? LIMIT ?
+                        ) AS unread_messages
+                    ''', (room_link, read_ids[room_link], limit)).fetchone()
+                    counts[room_link] = self._row(row)['unread']
+        return counts
+
+    def _set_read_position(self, conn, room_link, user_id, message_id):
+        self._execute(conn, '''
+            INSERT INTO read_positions (room_link, user_id, last_read_id) VALUES (?, ?, ?)
+            ON CONFLICT (room_link, user_id) DO UPDATE SET last_read_id = excluded.last_read_id
+            WHERE read_positions.last_read_id < excluded.last_read_id
+        ''', (room_link, user_id, message_id))
+
+    def mark_read(self, user_id, read_ids):
+        """Сдвигает курсоры прочтения: read_ids {room_link: id последнего отданного сообщения}"""
+        for group in self._group_rooms(read_ids):
+            with self._transaction(group[0]) as conn:
+                for room_link in group:
+                    self._set_read_position(conn, room_link, user_id, read_ids[room_link])
+
+    def _backfill_room_activity(self):
+        """Участники, активность и курсоры прочтения комнат, созданных до их появления"""
+        with self._transaction() as conn:
+            self._execute(conn, ROOM_MEMBERS_BACKFILL)
+        created = {row['link']: row['created_at'] for row in self._fetchall(
+            'SELECT link, COALESCE(created_at, CURRENT_TIMESTAMP) AS created_at FROM rooms')}
+        for group in self._group_rooms(created):
+            with self._transaction(group[0]) as conn:
+                for query in ROOM_ACTIVITY_BACKFILL:
+                    self._execute(conn, query)
+                # Комнаты без сообщений: последняя активность - создание
+                self._executemany(conn, '''
+                    INSERT INTO room_activity (room_link, last_activity) VALUES (?, ?)
+                    ON CONFLICT (room_link) DO NOTHING
+                ''', [(room_link, created[room_link]) for room_link in group])
+                self._execute(conn, READ_POSITIONS_BACKFILL)
+
+    def get_retention_policy(self, room_link):
+        return self._fetchone('SELECT max_age_days, max_messages FROM room_retention WHERE room_link = ?',
+                              (room_link,))
+
+    def set_retention_policy(self, room_link, max_age_days, max_messages):
+        with self._transaction() as conn:
+            self._execute(conn, '''
+                INSERT INTO room_retention (room_link, max_age_days, max_messages) VALUES (?, ?, ?)
+                ON CONFLICT(room_link) DO UPDATE SET max_age_days = excluded.max_age_days,
+                                                     max_messages = excluded.max_messages
+            ''', (room_link, max_age_days, max_messages))
+
+    def list_retention_rooms(self, all_rooms=False):
+        if all_rooms:
+            return [row['link'] for row in self._fetchall('SELECT link FROM rooms')]
+        return [row['room_link'] for row in self._fetchall('SELECT room_link FROM room_retention')]
+
+    # Сообщения
+
+    def _lock_room_messages(self, conn, room_link):
+        """Упорядочивает вставки сообщений комнаты: id фиксируются по возрастанию.
+
+        Клиенты и кэш читают новые сообщения как id > последнего увиденного,
+        поэтому сообщение с меньшим id не должно появиться позже большего.
+        """
+
+    def add_message(self, room_link, user_id, message):
+        with self._transaction(room_link) as conn:
+            self._lock_room_messages(conn, room_link)
+            row = self._row(self._execute(conn, '''
+                INSERT INTO messages (room_link, user_id, message) VALUES (?, ?, ?)
+                RETURNING id, timestamp
+            ''', (room_link, user_id, message)).fetchone())
+            # Активность комнаты и курсор автора - в той же транзакции и той же базе
+            self._execute(conn, '''
+                INSERT INTO room_activity (room_link, last_message_id, last_activity) VALUES (?, ?, ?)
+                ON CONFLICT (room_link) DO UPDATE SET last_message_id = excluded.last_message_id,
+                                                      last_activity = excluded.last_activity
+                WHERE room_activity.last_message_id < excluded.last_message_id
+            ''', (room_link, row['id'], row['timestamp']))
+            self._set_read_position(conn, room_link, user_id, row['id'])
+            event = {'type': 'message', 'room_link': room_link, 'id': row['id']}
+            self._notify(conn, event)
+        self._committed(event)
+        return row
+
+    def get_messages(self, room_link, after_id, limit=None):
+        query = '''
+            SELECT messages.*, users.username
+            FROM messages
+            JOIN users ON messages.user_id = users.id
+            WHERE room_link = ? AND messages.id > ?
+            ORDER BY messages.id ASC
+        '''
+        params = (room_link, after_id)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params += (limit,)
+        return self._fetchall(query, params, room_link=room_link)
+
+    def get_history(self, room_link, before_id, limit):
+        messages = self._fetchall('''
+            SELECT messages.*, users.username
+            FROM messages
+            JOIN users ON messages.user_id = users.id
+            WHERE room_link = ? AND messages.id < ?
+            ORDER BY messages.id DESC
+            LIMIT ?
+        ''', (room_link, before_id, limit), room_link=room_link)
+        messages.reverse()
+        return messages
+
+    # Массовая загрузка
+
+    def bulk_add_messages(self, room_link, rows):
+        """Вставляет сообщения одной транзакцией; rows: [(user_id, message, timestamp)]"""
+        with self._transaction(room_link) as conn:
+            self._lock_room_messages(conn, room_link)
+            self._executemany(conn, 'INSERT INTO messages (room_link, user_id, message, timestamp) VALUES (?, ?, ?, ?)',
+                              [(room_link, *row) for row in rows])
+            self._execute(conn, '''
+                INSERT INTO room_activity (room_link, last_message_id, last_activity)
+                SELECT room_link, MAX(id), MAX(timestamp) FROM messages WHERE room_link = ? GROUP BY room_link
+                ON CONFLICT (room_link) DO UPDATE SET last_message_id = excluded.last_message_id,
+                                                      last_activity = excluded.last_activity
+                WHERE room_activity.last_message_id < excluded.last_message_id
+            ''', (room_link,))
+
+    def drop_message_indexes(self, room_link):
+        with self._transaction(room_link) as conn:
+            for name in MESSAGE_INDEXES:
+                self._execute(conn, f'DROP INDEX IF EXISTS {name}')
+
+    def restore_message_indexes(self, room_link):
+        raise NotImplementedError
+
+    def find_retention_cutoff(self, room_link, max_age_days, max_messages):
+        """Наибольший id сообщения, которое вышло за пределы политики хранения"""
+        cutoff_id = 0
+        with self._transaction(room_link) as conn:
+            if max_age_days:
+                threshold = (datetime.utcnow() - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+                row = self._row(self._execute(conn, '''
+                    SELECT MAX(id) AS id FROM messages WHERE room_link = ? AND timestamp < ?
+                ''', (room_link, threshold)).fetchone())
+                cutoff_id = max(cutoff_id, row['id'] or 0)
+            if max_messages:
+                row = self._execute(conn, '''
+                    SELECT id FROM messages WHERE room_link = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                ''', (room_link, max_messages)).fetchone()
+                if row:
+                    cutoff_id = max(cutoff_id, self._row(row)['id'])
+        return cutoff_id
+
+    def get_messages_upto(self, room_link, cutoff_id, limit):
+        return self._fetchall('''
+            SELECT messages.id, messages.room_link, messages.user_id, users.username,
+                   messages.message, messages.timestamp
+            FROM messages
+            LEFT JOIN users ON messages.user_id = users.id
+            WHERE room_link = ? AND messages.id <= ?
+            ORDER BY messages.id ASC
+            LIMIT ?
+        ''', (room_link, cutoff_id, limit), room_link=room_link)
+
+    def delete_messages(self, room_link, message_ids):
+        with self._transaction(room_link) as conn:
+            for start in range(0, len(message_ids), DELETE_CHUNK_SIZE):
+                chunk = message_ids[start:start + DELETE_CHUNK_SIZE]
+                placeholders = ', '.join('?' for _ in chunk)
+                self._execute(conn, f'DELETE FROM messages WHERE room_link = ? AND id IN ({placeholders})',
+                              (room_link, *chunk))
+
+    def compact(self, room_link):
+        """Освобождает место после удаления сообщений; возвращает число страниц"""
+        return 0
+
+    # Файлы
+
+    def add_file(self, room_link, user_id, filename, original_filename, file_path, file_size, file_type,
+                 stored_size=None, encoding=None):
+        stored_size = stored_size if stored_size is not None else file_size
+        with self._transaction(room_link) as conn:
+            row = self._row(self._execute(conn, '''
+                INSERT INTO files (room_link, user_id, filename, original_filename, file_path, file_size, file_type,
+                                   stored_size, encoding)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                RETURNING id
+            ''', (room_link, user_id, filename, original_filename, file_path, file_size, file_type,
+                  stored_size, encoding)).fetchone())
+            self._add_usage(conn, room_link, user_id, 1, file_size, stored_size)
+            event = {'type': 'file', 'room_link': room_link, 'id': row['id']}
+            self._notify(conn, event)
+        self._committed(event)
+        return row['id']
+
+    def get_files(self, room_link):
+        return self._fetchall('''
+            SELECT files.*, users.username
+            FROM files
+            JOIN users ON files.user_id = users.id
+            WHERE room_link = ?
+            ORDER BY upload_date DESC
+        ''', (room_link,), room_link=room_link)
+
+    def get_file(self, file_id, room_link=None):
+        return self._fetchone('SELECT * FROM files WHERE id = ?', (file_id,), room_link=room_link)
+
+    def delete_file(self, file_id, room_link=None):
+        with self._transaction(room_link) as conn:
+            row = self._execute(conn, '''
+                DELETE FROM files WHERE id = ?
+                RETURNING room_link, user_id, file_size, COALESCE(stored_size, file_size) AS stored_size
+            ''', (file_id,)).fetchone()
+            if row:
+                row = self._row(row)
+                self._add_usage(conn, row['room_link'], row['user_id'], -1, -row['file_size'], -row['stored_size'])
+
+    def set_stored_size(self, file_id, room_link, stored_size):
+        """Исправляет размер файла на диске; счетчики пересчитывает rebuild_usage"""
+        with self._transaction(room_link) as conn:
+            self._execute(conn, 'UPDATE files SET stored_size = ? WHERE id = ?', (stored_size, file_id))
+
+    def set_file_metadata(self, file_id, room_link, sha256, mime_type, thumbnails):
+        with self._transaction(room_link) as conn:
+            self._execute(conn, '''
+                UPDATE files SET sha256 = ?, mime_type = ?, thumbnails = ?, processed_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (sha256, mime_type, ','.join(str(size) for size in thumbnails), file_id))
+            event = {'type': 'file_processed', 'room_link': room_link, 'id': file_id}
+            self._notify(conn, event)
+        self._committed(event)
+
+    def list_unprocessed_files(self):
+        return self._fetchall('SELECT id, room_link FROM files WHERE processed_at IS NULL ORDER BY id')
+
+    def list_stored_files(self):
+        """Расположение и размер на диске всех файлов (для сверки с диском)"""
+        return self._fetchall('''
+            SELECT id, room_link, file_path, COALESCE(stored_size, file_size) AS stored_size
+            FROM files ORDER BY id
+        ''')
+
+    # Занятое место. Счетчики читаются одной строкой и не зависят от числа файлов.
+
+    def _add_usage(self, conn, room_link, user_id, files, file_size, stored_size):
+        """Сдвигает счетчики комнаты и пользователя внутри транзакции записи файла"""
+        for table, key, value in (('room_usage', 'room_link', room_link), ('user_usage', 'user_id', user_id)):
+            self._execute(conn, f'''
+                INSERT INTO {table} ({key}, files, file_size, stored_size) VALUES (?, ?, ?, ?)
+                ON CONFLICT ({key}) DO UPDATE SET files = {table}.files + excluded.files,
+                                                   file_size = {table}.file_size + excluded.file_size,
+                                                   stored_size = {table}.stored_size + excluded.stored_size
+            ''', (value, files, file_size, stored_size))
+
+    def get_room_usage(self, room_link):
+        """{files, file_size, stored_size} загрузок комнаты"""
+        row = self._fetchone('SELECT files, file_size, stored_size FROM room_usage WHERE room_link = ?',
+                             (room_link,), room_link=room_link)
+        return row or dict(EMPTY_USAGE)
+
+    def get_user_usage(self, user_id):
+        """{files, file_size, stored_size} загрузок пользователя во всех комнатах"""
+        row = self._fetchone('SELECT files, file_size, stored_size FROM user_usage WHERE user_id = ?', (user_id,))
+        return row or dict(EMPTY_USAGE)
+
+    def _lock_usage(self, conn):
+        """Не дает загрузкам менять счетчики, пока они пересчитываются"""
+
+    def _rebuild_usage(self, conn):
+        self._lock_usage(conn)
+        for query in USAGE_REBUILD:
+            self._execute(conn, query)
+
+    def rebuild_usage(self):
+        """Пересчитывает счетчики занятого места по таблице files"""
+        with self._transaction() as conn:
+            self._rebuild_usage(conn)
+
+    # Синхронизация нескольких комнат
+
+    def _group_rooms(self, room_links):
+        """Разбивает комнаты на группы, читаемые через одно соединение"""
+        return [sorted(room_links)] if room_links else []
+
+    def sync_rooms(self, message_cursors, file_cursors, limit):
+        """Новые сообщения и изменившиеся списки файлов нескольких комнат.
+
+        message_cursors: {room_link: last_message_id}, file_cursors:
+        {room_link: (last_file_id, file_count, processed_count)}. Возвращает {room_link: {...}}
+        только для существующих комнат; ключ files есть, если список изменился.
+        Сообщений отдается не больше limit на комнату, has_more - остались ли еще.
+        """
+        result = {}
+        for group in self._group_rooms(set(message_cursors) | set(file_cursors)):
+            with self._transaction(group[0]) as conn:
+                self._sync_group(conn, group, message_cursors, file_cursors, limit, result)
+        return result
+
+    def _sync_group(self, conn, group, message_cursors, file_cursors, limit, result):
+        placeholders = ', '.join('?' for _ in group)
+        rows = self._execute(conn, f'SELECT link FROM rooms WHERE link IN ({placeholders})', group).fetchall()
+        found = [self._row(row)['link'] for row in rows]
+        for room_link in found:
+            result[room_link] = {}
+
+        rooms = [room_link for room_link in found if room_link in message_cursors]
+        if rooms:
+            # Свой LIMIT у каждой комнаты: одна активная комната не вытесняет
+            # остальные, а каждый подзапрос читает не больше limit + 1 строк индекса
+            query = ' UNION ALL '.join(f'''
+                SELECT * FROM (
+                    SELECT messages.*, users.username
+                    FROM messages
+                    JOIN users ON messages.user_id = users.id
+                    WHERE room_link = ? AND messages.id > ?
+                    ORDER BY messages.id ASC
+                    LIMIT ?
+                ) AS room_{index}
+            ''' for index in range(len(rooms)))
+            params = [value for room_link in rooms for value in (room_link, message_cursors[room_link], limit + 1)]
+            for room_link in rooms:
+                result[room_link]['messages'] = []
+            for row in self._execute(conn, query + ' ORDER BY id', params).fetchall():
+                row = self._row(row)
+                result[row['room_link']]['messages'].append(row)
+            for room_link in rooms:
+                messages = result[room_link]['messages']
+                result[room_link]['has_more'] = len(messages) > limit
+                del messages[limit:]
+
+        rooms = [room_link for room_link in found if room_link in file_cursors]
+        if rooms:
+            placeholders = ', '.join('?' for _ in rooms)
+            summary = {}
+            for row in self._execute(conn, f'''
+                SELECT room_link, MAX(id) AS last_file_id, COUNT(*) AS file_count,
+                       COUNT(processed_at) AS processed_count
+                FROM files
+                WHERE room_link IN ({placeholders})
+                GROUP BY room_link
+            ''', rooms).fetchall():
+                row = self._row(row)
+                summary[row['room_link']] = (row['last_file_id'], row['file_count'], row['processed_count'])
+
+            # Новый файл увеличивает MAX(id), удаление уменьшает COUNT(*),
+            # завершение фоновой обработки увеличивает processed_count
+            changed = [room_link for room_link in rooms
+                       if summary.get(room_link, (0, 0, 0)) != tuple(file_cursors[room_link])]
+            if changed:
+                placeholders = ', '.join('?' for _ in changed)
+                for room_link in changed:
+                    result[room_link]['files'] = []
+                for row in self._execute(conn, f'''
+                    SELECT files.*, users.username
+                    FROM files
+                    JOIN users ON files.user_id = users.id
+                    WHERE room_link IN ({placeholders})
+                    ORDER BY upload_date DESC
+                ''', changed).fetchall():
+                    row = self._row(row)
+                    result[row['room_link']]['files'].append(row)
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище в SQLite с необязательным шардированием по комнатам.
+
+    При shard_count > 0 сообщения и файлы комнаты лежат в базе шарда,
+    выбранной по crc32 ссылки комнаты. Шард открывается как main, а основная
+    база подключается как core, поэтому запросы с JOIN users не меняются,
+    а запись в шард блокирует только его файл.
+    """
+
+    integrity_errors = (sqlite3.IntegrityError,)
+
+    def __init__(self, database, shard_count=0, shard_folder='shards'):
+        super().__init__()
+        self.database = database
+        self.shard_count = shard_count
+        self.shard_folder = shard_folder
+
+    @property
+    def sharded(self):
+        return bool(self.shard_count)
+
+    def shard_path(self, index):
+        return os.path.join(self.shard_folder, f'shard_{index}.db')
+
+    def room_shard(self, room_link):
+        return zlib.crc32(room_link.encode('utf-8')) % self.shard_count
+
+    def _group_rooms(self, room_links):
+        if not self.shard_count:
+            return super()._group_rooms(room_links)
+        groups = {}
+        for room_link in sorted(room_links):
+            groups.setdefault(self.room_shard(room_link), []).append(room_link)
+        return list(groups.values())
+
+    def connect(self, room_link=None):
+        if room_link is None or not self.shard_count:
+            conn = sqlite3.connect(self.database)
+            conn.row_factory = sqlite3.Row
+            return conn
+        return self.connect_shard(self.room_shard(room_link))
+
+    def connect_shard(self, index):
+        conn = sqlite3.connect(self.shard_path(index))
+        conn.row_factory = sqlite3.Row
+        conn.execute('ATTACH DATABASE ? AS core', (self.database,))
+        return conn
+
+    def _acquire(self, room_link=None):
+        return self.connect(room_link)
+
+    def _release(self, conn):
+        conn.close()
+
+    def _committed(self, event):
+        # Без внешнего брокера уведомления доходят только до своего процесса
+        self._dispatch(event)
+
+    def init_schema(self):
+        conn = sqlite3.connect(self.database)
+        cursor = conn.cursor()
+
+        self._enable_incremental_vacuum(cursor)
+        self._enable_wal(cursor)
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                salt TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rooms (
+                link TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                password TEXT NOT NULL,
+                salt TEXT NOT NULL,
+                created_by INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (created_by) REFERENCES users (id)
+            )
+        ''')
+
+        self._create_room_tables(cursor)
+
+        # Политики хранения сообщений по комнатам
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_retention (
+                room_link TEXT PRIMARY KEY,
+                max_age_days INTEGER,
+                max_messages INTEGER,
+                FOREIGN KEY (room_link) REFERENCES rooms (link)
+            )
+        ''')
+
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_rooms_link ON rooms(link)')
+
+        # Участники комнат; активность и курсоры прочтения - в базе комнаты
+        backfill = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'room_members'").fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_members (
+                user_id INTEGER NOT NULL,
+                room_link TEXT NOT NULL,
+                PRIMARY KEY (user_id, room_link),
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (room_link) REFERENCES rooms (link)
+            )
+        ''')
+
+        conn.commit()
+
+        # Сообщения и файлы, записанные до включения шардов, остались бы в
+        # основной базе, где их никто не читает: отказываемся стартовать
+        if self.shard_count:
+            for table in ('messages', 'files'):
+                if cursor.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+                    conn.close()
+                    raise RuntimeError(f"SHARD_COUNT is {self.shard_count}, but the main database still has rows "
+                                       f"in {table}; they would be hidden. Move them to the shards or set "
+                                       f"SHARD_COUNT = 0")
+        conn.close()
+
+        if self.shard_count:
+            os.makedirs(self.shard_folder, exist_ok=True)
+            for index in range(self.shard_count):
+                conn = sqlite3.connect(self.shard_path(index))
+                cursor = conn.cursor()
+                self._enable_incremental_vacuum(cursor)
+                self._enable_wal(cursor)
+                self._create_room_tables(cursor)
+                conn.commit()
+                conn.close()
+
+        if backfill:
+            self._backfill_room_activity()
+
+    def _enable_incremental_vacuum(self, cursor):
+        # Инкрементальный auto_vacuum позволяет возвращать место после архивации
+        # без полного VACUUM; для существующей базы режим включается один раз
+        if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cursor.execute('VACUUM')
+
+    def _enable_wal(self, cursor):
+        # В режиме WAL читатели (в том числе резервное копирование) не блокируют
+        # писателей; режим сохраняется в файле базы
+        cursor.execute('PRAGMA journal_mode = WAL')
+
+    def _create_room_tables(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                room_link TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (room_link) REFERENCES rooms (link),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+
+        # Таблица для файлов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                room_link TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                original_filename TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                file_type TEXT NOT NULL,
+                upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (room_link) REFERENCES rooms (link),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+
+        self._add_missing_columns(cursor, 'files', FILE_STORAGE_COLUMNS + FILE_METADATA_COLUMNS)
+
+        # Занятое место по комнатам и пользователям; в шарде - только его комнаты
+        backfill = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'room_usage'").fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_usage (
+                room_link TEXT PRIMARY KEY,
+                files INTEGER NOT NULL DEFAULT 0,
+                file_size INTEGER NOT NULL DEFAULT 0,
+                stored_size INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_usage (
+                user_id INTEGER PRIMARY KEY,
+                files INTEGER NOT NULL DEFAULT 0,
+                file_size INTEGER NOT NULL DEFAULT 0,
+                stored_size INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        if backfill:
+            for query in USAGE_REBUILD:
+                cursor.execute(query)
+
+        # Последнее сообщение комнаты и курсоры прочтения ее участников
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS room_activity (
+                room_link TEXT PRIMARY KEY,
+                last_message_id INTEGER NOT NULL DEFAULT 0,
+                last_activity TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS read_positions (
+                room_link TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                last_read_id INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (room_link, user_id)
+            )
+        ''')
+
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_room_link ON messages(room_link)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_room_link ON files(room_link)')
+
+    def _add_missing_columns(self, cursor, table, columns):
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()}
+        for name, column_type in columns:
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+    def restore_message_indexes(self, room_link):
+        conn = self.connect(room_link)
+        try:
+            self._create_room_tables(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+
+    def list_member_rooms(self, user_id, limit, before=None):
+        if not self.shard_count:
+            return super().list_member_rooms(user_id, limit, before)
+        # Каждый шард отдает свою первую страницу (участники и комнаты читаются
+        # из core), общая страница - лучшие из них
+        query, params = self._member_rooms_query(user_id, limit, before)
+        rooms = []
+        for index in range(self.shard_count):
+            conn = self.connect_shard(index)
+            try:
+                rooms.extend(dict(row) for row in conn.execute(query, params).fetchall())
+            finally:
+                conn.close()
+        rooms.sort(key=lambda room: (room['last_activity'], room['link']), reverse=True)
+        return rooms[:limit]
+
+    def list_unprocessed_files(self):
+        if not self.shard_count:
+            return super().list_unprocessed_files()
+        files = []
+        for index in range(self.shard_count):
+            conn = sqlite3.connect(self.shard_path(index))
+            conn.row_factory = sqlite3.Row
+            try:
+                files.extend(dict(row) for row in conn.execute(
+                    'SELECT id, room_link FROM files WHERE processed_at IS NULL ORDER BY id').fetchall())
+            finally:
+                conn.close()
+        return files
+
+    def list_stored_files(self):
+        if not self.shard_count:
+            return super().list_stored_files()
+        files = []
+        for index in range(self.shard_count):
+            conn = sqlite3.connect(self.shard_path(index))
+            conn.row_factory = sqlite3.Row
+            try:
+                files.extend(dict(row) for row in conn.execute('''
+                    SELECT id, room_link, file_path, COALESCE(stored_size, file_size) AS stored_size
+                    FROM files ORDER BY id
+                ''').fetchall())
+            finally:
+                conn.close()
+        return files
+
+    def get_user_usage(self, user_id):
+        if not self.shard_count:
+            return super().get_user_usage(user_id)
+        # Пользователь загружает в комнаты разных шардов: складываем по одной строке из каждого
+        usage = dict(EMPTY_USAGE)
+        for index in range(self.shard_count):
+            conn = self.connect_shard(index)
+            try:
+                row = conn.execute('SELECT files, file_size, stored_size FROM user_usage WHERE user_id = ?',
+                                   (user_id,)).fetchone()
+            finally:
+                conn.close()
+            if row:
+                for key in usage:
+                    usage[key] += row[key]
+        return usage
+
+    def rebuild_usage(self):
+        if not self.shard_count:
+            return super().rebuild_usage()
+        for index in range(self.shard_count):
+            conn = self.connect_shard(index)
+            try:
+                with conn:
+                    self._rebuild_usage(conn)
+            finally:
+                conn.close()
+
+    def compact(self, room_link, pause=0.05):
+        # Свободные страницы возвращаются ОС небольшими порциями,
+        # чтобы не держать блокировку записи долго
+        conn = self.connect(room_link)
+        conn.isolation_level = None
+        freed = 0
+        try:
+            while True:
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if not free_pages:
+                    break
+                step = min(VACUUM_STEP_PAGES, free_pages)
+                conn.execute(f'PRAGMA incremental_vacuum({step})').fetchall()
+                freed += step
+                time.sleep(pause)
+        finally:
+            conn.close()
+        return freed
+
+
+class PostgresStorage(BaseStorage):
+    """Хранилище в PostgreSQL с пулом соединений.
+
+    О новых сообщениях и файлах сообщается через NOTIFY в канал
+    chat_events, поэтому слушатели получают события от всех процессов.
+    """
+
+    channel = 'chat_events'
+
+    SCHEMA = [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGSERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            salt TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS rooms (
+            link TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            password TEXT NOT NULL,
+            salt TEXT NOT NULL,
+            created_by BIGINT NOT NULL REFERENCES users (id),
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id BIGSERIAL PRIMARY KEY,
+            room_link TEXT NOT NULL REFERENCES rooms (link),
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS files (
+            id BIGSERIAL PRIMARY KEY,
+            room_link TEXT NOT NULL REFERENCES rooms (link),
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            filename TEXT NOT NULL,
+            original_filename TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            file_size BIGINT NOT NULL,
+            file_type TEXT NOT NULL,
+            upload_date TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS room_retention (
+            room_link TEXT PRIMARY KEY REFERENCES rooms (link),
+            max_age_days INTEGER,
+            max_messages INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS room_usage (
+            room_link TEXT PRIMARY KEY REFERENCES rooms (link),
+            files BIGINT NOT NULL DEFAULT 0,
+            file_size BIGINT NOT NULL DEFAULT 0,
+            stored_size BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_usage (
+            user_id BIGINT PRIMARY KEY REFERENCES users (id),
+            files BIGINT NOT NULL DEFAULT 0,
+            file_size BIGINT NOT NULL DEFAULT 0,
+            stored_size BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS room_members (
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            room_link TEXT NOT NULL REFERENCES rooms (link),
+            PRIMARY KEY (user_id, room_link)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS room_activity (
+            room_link TEXT PRIMARY KEY REFERENCES rooms (link),
+            last_message_id BIGINT NOT NULL DEFAULT 0,
+            last_activity TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS read_positions (
+            room_link TEXT NOT NULL REFERENCES rooms (link),
+            user_id BIGINT NOT NULL REFERENCES users (id),
+            last_read_id BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (room_link, user_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_messages_room_link ON messages (room_link, id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_files_room_link ON files (room_link)',
+    ] + [f'ALTER TABLE files ADD COLUMN IF NOT EXISTS {name} {column_type}'
+         for name, column_type in FILE_STORAGE_COLUMNS + FILE_METADATA_COLUMNS]
+
+    def __init__(self, dsn, pool_size=10, pool_timeout=30):
+        if psycopg2 is None:
+            raise RuntimeError('psycopg2 is not installed')
+        super().__init__()
+        self.dsn = dsn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, dsn)
+        # getconn не ждет свободного соединения, а сразу бросает PoolError:
+        # семафор по размеру пула заставляет лишние потоки подождать
+        self.pool_timeout = pool_timeout
+        self._pool_slots = threading.BoundedSemaphore(pool_size)
+        self.integrity_errors = (psycopg2.IntegrityError,)
+        self._listen_lock = threading.Lock()
+        self._listen_thread = None
+        # Слушатель подключен: уведомления других процессов доходят
+        self.listening = False
+
+    def _acquire(self, room_link=None):
+        if not self._pool_slots.acquire(timeout=self.pool_timeout):
+            raise RuntimeError(f"No free database connection in {self.pool_timeout} s")
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self._pool_slots.release()
+            raise
+
+    def _release(self, conn):
+        try:
+            self.pool.putconn(conn)
+        finally:
+            self._pool_slots.release()
+
+    def _cursor(self, conn):
+        return conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    def _prepare(self, query):
+        return query.replace('%', '%%').replace('?', '%s')
+
+    def _row(self, row):
+        # Даты приводим к строковому виду, который отдает SQLite
+        return {key: value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime) else value
+                for key, value in row.items()}
+
+    def _executemany(self, conn, query, rows):
+        # executemany psycopg2 делает запрос на каждую строку, execute_batch - на страницу
+        cursor = self._cursor(conn)
+        try:
+            psycopg2.extras.execute_batch(cursor, self._prepare(query), rows, page_size=1000)
+        except self.integrity_errors as e:
+            raise IntegrityError(str(e)) from e
+        return cursor
+
+    def restore_message_indexes(self, room_link):
+        self.init_schema()
+
+    def _lock_room_messages(self, conn, room_link):
+        # BIGSERIAL выдает id при вставке, а видимым он становится при COMMIT:
+        # без блокировки id 11 может зафиксироваться раньше id 10, и опрос
+        # по id > 10 пропустит десятое. Блокировка снимается вместе с транзакцией
+        self._execute(conn, 'SELECT pg_advisory_xact_lock(?, hashtext(?))', (MESSAGES_LOCK_CLASS, room_link))
+
+    def _lock_usage(self, conn):
+        # Загрузка, начатая до блокировки, допишет свой счетчик после пересчета,
+        # а ее строка files не попадет в пересчет, пока не зафиксирована
+        self._execute(conn, 'LOCK TABLE room_usage, user_usage IN EXCLUSIVE MODE')
+
+    def init_schema(self):
+        with self._transaction() as conn:
+            row = self._execute(conn, "SELECT to_regclass('room_members') AS found").fetchone()
+            backfill = self._row(row)['found'] is None
+            row = self._execute(conn, "SELECT to_regclass('room_usage') AS found").fetchone()
+            usage_backfill = self._row(row)['found'] is None
+            for statement in self.SCHEMA:
+                self._execute(conn, statement)
+            if usage_backfill:
+                self._rebuild_usage(conn)
+        if backfill:
+            self._backfill_room_activity()
+
+    def _notify(self, conn, event):
+        # NOTIFY доставляется слушателям только после COMMIT
+        self._execute(conn, 'SELECT pg_notify(?, ?)', (self.channel, json.dumps(event)))
+
+    def publish(self, event):
+        """Отправляет событие слушателям вне транзакции записи"""
+        with self._transaction() as conn:
+            self._notify(conn, event)
+
+    def add_listener(self, callback):
+        super().add_listener(callback)
+        with self._listen_lock:
+            if self._listen_thread is None:
+                self._listen_thread = threading.Thread(target=self._listen_loop, name='pg-listener', daemon=True)
+                self._listen_thread.start()
+
+    def _listen_loop(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN {self.channel}')
+                self.listening = True
+                # Пока слушателя не было, уведомления терялись
+                self._dispatch({'type': 'reset'})
+                while True:
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch(json.loads(notify.payload))
+            except Exception as e:
+                logger.error(f"Postgres listener error: {e}")
+                time.sleep(1)
+            finally:
+                self.listening = False
+                if conn is not None:
+                    conn.close()
+
+
+def create_storage(config):
+    """Создает хранилище по настройке STORAGE_BACKEND"""
+    backend = config.get('STORAGE_BACKEND', 'sqlite')
+    if backend == 'sqlite':
+        return SQLiteStorage(config['DATABASE'], config.get('SHARD_COUNT', 0), config.get('SHARD_FOLDER', 'shards'))
+    if backend == 'postgres':
+        return PostgresStorage(config['POSTGRES_DSN'], config.get('POSTGRES_POOL_SIZE', 10),
+                               config.get('POSTGRES_POOL_TIMEOUT', 30))
+    raise ValueError(f"Unknown storage backend: {backend}")
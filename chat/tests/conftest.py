@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import PostgresStorage, SQLiteStorage, psycopg2  # noqa: E402
+
+# Отдельная база Postgres для тестов: ее таблицы удаляются перед каждым тестом
+POSTGRES_DSN = os.environ.get('CHAT_TEST_POSTGRES_DSN')
+POSTGRES_TABLES = ('read_positions', 'room_activity', 'room_members', 'user_usage', 'room_usage', 'room_retention',
+                   'files', 'messages', 'rooms', 'users')
+
+
+def reset_postgres(dsn):
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn, conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {', '.join(POSTGRES_TABLES)} CASCADE")
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=['sqlite', 'sqlite_sharded', 'postgres'])
+def storage(request, tmp_path):
+    """Одни и те же тесты для каждого хранилища; Postgres - при CHAT_TEST_POSTGRES_DSN"""
+    if request.param == 'postgres':
+        if psycopg2 is None or not POSTGRES_DSN:
+            pytest.skip('CHAT_TEST_POSTGRES_DSN is not set')
+        reset_postgres(POSTGRES_DSN)
+        # Пул меньше числа потоков в тестах: запросы должны ждать соединение
+        storage = PostgresStorage(POSTGRES_DSN, pool_size=2, pool_timeout=10)
+    elif request.param == 'sqlite_sharded':
+        storage = SQLiteStorage(str(tmp_path / 'chat.db'), 4, str(tmp_path / 'shards'))
+    else:
+        storage = SQLiteStorage(str(tmp_path / 'chat.db'))
+    storage.init_schema()
+    yield storage
+    if request.param == 'postgres':
+        storage.pool.closeall()
+
+
+@pytest.fixture
+def alice(storage):
+    return storage.create_user('alice', 'hash', 'salt')
+
+
+@pytest.fixture
+def room(storage, alice):
+    storage.create_room('room1', 'Room 1', 'hash', 'salt', alice)
+    storage.add_room_member('room1', alice)
+    return 'room1'
@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+CHAT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Импорт и create_app занимают около 0.2 с; запас - на медленные машины CI
+STARTUP_BUDGET = 1.5
+
+# Замер в чистом процессе: импорт модуля, create_app и тяжелые зависимости,
+# которые не должны загружаться при старте
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+module = __import__(sys.argv[1])
+module.create_app()
+print(json.dumps({'seconds': time.perf_counter() - started,
+                  'heavy': [name for name in ('pandas', 'redis') if name in sys.modules]}))
+'''
+
+
+@pytest.mark.parametrize('path, module', [(CHAT_DIR, 'app'), (os.path.join(CHAT_DIR, 'admin'), 'db')])
+def test_startup_time(tmp_path, path, module):
+    # Каталоги, лог и ключ create_app создает в текущем каталоге
+    env = dict(os.environ, PYTHONPATH=path)
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, module], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    startup = json.loads(result.stdout.splitlines()[-1])
+    assert startup['heavy'] == []
+    assert startup['seconds'] < STARTUP_BUDGET
@@ -0,0 +1,155 @@
+import sys
+import threading
+
+import pytest
+
+from storage import IntegrityError
+
+
+def test_users_and_rooms(storage, alice, room):
+    assert storage.get_user_by_username('alice')['id'] == alice
+    assert storage.get_user_by_username('bob') is None
+    assert storage.get_room(room)['created_by'] == alice
+    assert storage.get_room('missing') is None
+    with pytest.raises(IntegrityError):
+        storage.create_user('alice', 'hash', 'salt')
+
+
+def test_messages_after_and_before(storage, alice, room):
+    ids = [storage.add_message(room, alice, f'message {i}')['id'] for i in range(5)]
+    assert ids == sorted(ids)
+
+    messages = storage.get_messages(room, ids[1])
+    assert [msg['id'] for msg in messages] == ids[2:]
+    assert messages[0]['username'] == 'alice'
+    assert [msg['id'] for msg in storage.get_messages(room, 0, limit=2)] == ids[:2]
+
+    history = storage.get_history(room, ids[3], 2)
+    assert [msg['message'] for msg in history] == ['message 1', 'message 2']
+    assert storage.get_history(room, sys.maxsize, 10)[-1]['id'] == ids[-1]
+
+
+def test_files_and_usage(storage, alice, room):
+    first = storage.add_file(room, alice, 'a.txt', 'a.txt', '/tmp/a.txt', 100, 'text/plain', stored_size=40,
+                             encoding='gzip')
+    storage.add_file(room, alice, 'b.txt', 'b.txt', '/tmp/b.txt', 10, 'text/plain')
+    assert {file['filename'] for file in storage.get_files(room)} == {'a.txt', 'b.txt'}
+    assert storage.get_room_usage(room) == {'files': 2, 'file_size': 110, 'stored_size': 50}
+    assert storage.get_user_usage(alice) == {'files': 2, 'file_size': 110, 'stored_size': 50}
+
+    storage.delete_file(first, room)
+    assert storage.get_file(first, room) is None
+    assert storage.get_room_usage(room) == {'files': 1, 'file_size': 10, 'stored_size': 10}
+
+    storage.set_stored_size(storage.get_files(room)[0]['id'], room, 7)
+    storage.rebuild_usage()
+    assert storage.get_user_usage(alice) == {'files': 1, 'file_size': 10, 'stored_size': 7}
+
+
+def test_sync_rooms(storage, alice, room):
+    storage.create_room('room2', 'Room 2', 'hash', 'salt', alice)
+    first = storage.add_message(room, alice, 'one')['id']
+    second = storage.add_message(room, alice, 'two')['id']
+    file_id = storage.add_file('room2', alice, 'a.txt', 'a.txt', '/tmp/a.txt', 1, 'text/plain')
+
+    result = storage.sync_rooms({room: first, 'room2': 0, 'missing': 0},
+                                {room: (0, 0, 0), 'room2': (0, 0, 0)}, 10)
+    assert set(result) == {room, 'room2'}
+    assert [msg['id'] for msg in result[room]['messages']] == [second]
+    assert result[room]['has_more'] is False
+    assert result['room2']['messages'] == []
+    assert 'files' not in result[room]
+    assert [file['id'] for file in result['room2']['files']] == [file_id]
+
+    result = storage.sync_rooms({}, {'room2': (file_id, 1, 0)}, 10)
+    assert result == {'room2': {}}
+
+
+def test_sync_rooms_pages_each_room(storage, alice, room):
+    storage.create_room('room2', 'Room 2', 'hash', 'salt', alice)
+    ids = [storage.add_message(room, alice, f'message {i}')['id'] for i in range(5)]
+    other = storage.add_message('room2', alice, 'other')['id']
+
+    result = storage.sync_rooms({room: 0, 'room2': 0}, {}, 2)
+    assert [msg['id'] for msg in result[room]['messages']] == ids[:2]
+    assert result[room]['has_more'] is True
+    assert [msg['id'] for msg in result['room2']['messages']] == [other]
+    assert result['room2']['has_more'] is False
+
+    result = storage.sync_rooms({room: ids[3]}, {}, 2)
+    assert [msg['id'] for msg in result[room]['messages']] == ids[4:]
+    assert result[room]['has_more'] is False
+
+
+def test_concurrent_writers_do_not_skip_messages(storage, alice, room):
+    """Опрос по id > курсора видит все сообщения, даже когда пишут сразу несколько потоков"""
+    writers, per_writer = 8, 20
+    seen = []
+    done = threading.Event()
+    errors = []
+
+    def write():
+        try:
+            for i in range(per_writer):
+                storage.add_message(room, alice, f'message {i}')
+        except Exception as e:
+            errors.append(e)
+
+    def poll():
+        cursor = 0
+        while True:
+            finished = done.is_set()
+            for msg in storage.get_messages(room, cursor):
+                seen.append(msg['id'])
+                cursor = msg['id']
+            if finished:
+                return
+
+    poller = threading.Thread(target=poll)
+    poller.start()
+    threads = [threading.Thread(target=write) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    poller.join()
+
+    assert errors == []
+    assert len(seen) == writers * per_writer
+    assert seen == sorted(set(seen))
+
+
+def test_member_rooms_and_unread(storage, alice, room):
+    bob = storage.create_user('bob', 'hash', 'salt')
+    storage.add_room_member(room, bob)
+    ids = [storage.add_message(room, bob, f'message {i}')['id'] for i in range(3)]
+    storage.create_room('room2', 'Room 2', 'hash', 'salt', alice)
+    storage.add_room_member('room2', alice)
+    storage.add_message('room2', alice, 'own message')
+
+    rooms = storage.list_member_rooms(alice, 10)
+    assert {room_row['link'] for room_row in rooms} == {room, 'room2'}
+    first = storage.list_member_rooms(alice, 1)
+    rest = storage.list_member_rooms(alice, 10, (first[0]['last_activity'], first[0]['link']))
+    assert [room_row['link'] for room_row in first + rest] == [room_row['link'] for room_row in rooms]
+
+    read_ids = {room_row['link']: room_row['last_read_id'] for room_row in rooms
+                if room_row['last_read_id'] < room_row['last_message_id']}
+    assert read_ids == {room: 0}
+    assert storage.count_unread(read_ids, 10) == {room: 3}
+    assert storage.count_unread(read_ids, 2) == {room: 2}
+
+    storage.mark_read(alice, {room: ids[1]})
+    storage.mark_read(alice, {room: ids[0]})
+    row = {room_row['link']: room_row for room_row in storage.list_member_rooms(alice, 10)}[room]
+    assert storage.count_unread({room: row['last_read_id']}, 10) == {room: 1}
+
+    # Новый участник не видит прежнюю историю непрочитанной
+    carol = storage.create_user('carol', 'hash', 'salt')
+    storage.add_room_member(room, carol)
+    row = storage.list_member_rooms(carol, 10)[0]
+    assert row['last_read_id'] == row['last_message_id'] == ids[-1]
+
+    storage.remove_room_member(room, carol)
+    assert storage.list_member_rooms(carol, 10) == []
@@ -0,0 +1,50 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Загрузка пишется на диск раньше, чем появляется ее строка в files,
+# поэтому свежий файл без записи - скорее всего незавершенная загрузка
+ORPHAN_MIN_AGE = 3600
+
+
+def reconcile_usage(storage, upload_folder, remove_orphans=False, remove_missing=False,
+                    orphan_min_age=ORPHAN_MIN_AGE):
+    """Сверяет файлы в базе с каталогом загрузок и пересчитывает счетчики места.
+
+    stored_size исправляется по фактическому размеру файла. Записи без файла
+    удаляются при remove_missing, файлы без записи старше orphan_min_age - при
+    remove_orphans; иначе они только подсчитываются. Возвращает статистику.
+    """
+    stats = {'files': 0, 'resized': 0, 'missing': 0, 'orphans': 0, 'removed': 0}
+    known = set()
+    for file in storage.list_stored_files():
+        stats['files'] += 1
+        known.add(os.path.realpath(file['file_path']))
+        try:
+            size = os.path.getsize(file['file_path'])
+        except FileNotFoundError:
+            stats['missing'] += 1
+            logger.warning(f"Usage: file {file['id']} of room {file['room_link']} is missing on disk")
+            if remove_missing:
+                storage.delete_file(file['id'], file['room_link'])
+                stats['removed'] += 1
+            continue
+        if size != file['stored_size']:
+            storage.set_stored_size(file['id'], file['room_link'], size)
+            stats['resized'] += 1
+
+    # Пересчет после исправления размеров: счетчики совпадают с files на момент пересчета
+    storage.rebuild_usage()
+
+    now = time.time()
+    with os.scandir(upload_folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or os.path.realpath(entry.path) in known:
+                continue
+            stats['orphans'] += 1
+            if remove_orphans and now - entry.stat().st_mtime > orphan_min_age:
+                os.remove(entry.path)
+                stats['removed'] += 1
+    return stats